@@ -0,0 +1,207 @@
+import time
+import argparse
+import numpy as np
+from cards import COLORS, NUMBERS, card_from
+from game_logic import Deck
+
+''' This module plays many games of Hanabi at once for strategy analysis. The BatchGameState holds N games as
+NumPy arrays and applies one action per game with every step(), following the same rules as
+GameState.update. Cards are stored as their codes from the cards module (0 is an empty slot).
+
+Run it directly to measure the number of games per second with a random policy:
+    python batch_engine.py --games 10000 --players 2'''
+
+# Action types, one per event of GameState.update:
+INFO = 0        # InfoUsed
+BURN = 1        # CardBurned
+PLACE = 2       # CardPlaced
+PULL = 3        # CardPull
+NEXT = 4        # NextTurn
+
+N_CARDS = 4                                             # Number of cards in one player's hands
+N_CODES = 1 + len(COLORS) * len(NUMBERS)                # Card codes, including EMPTY
+MAX_INFO_POINTS = 9
+MAX_LIFE_POINTS = 3
+
+# Card code -> color index and number, code 0 (EMPTY) maps to color 0 and number 0:
+CODE_COLOR = np.array([0] + [(code - 1) // len(NUMBERS) for code in range(1, N_CODES)], dtype=np.int64)
+CODE_NUMBER = np.array([0] + [(code - 1) % len(NUMBERS) + 1 for code in range(1, N_CODES)], dtype=np.int8)
+
+# The cards of one deck, in the order of Deck:
+DECK_CODES = np.array([card_from(col, num).code
+                       for col in Deck.colors
+                       for num, count in Deck.deck_dict.items()
+                       for _ in range(count)], dtype=np.int8)
+
+
+class BatchGameState:
+
+    """ N games of Hanabi with the same number of players, stored as arrays with the game index first. """
+
+    def __init__(self, decks, n_players):
+        self.n_games = len(decks)
+        self.n_players = n_players
+        assert 2 <= n_players <= 4
+
+        # Deck permutations and the index of the next card to be pulled in each:
+        self.decks = np.asarray(decks, dtype=np.int8)
+        self.deck_position = np.full(self.n_games, n_players * N_CARDS, dtype=np.int64)
+
+        # Deal the first cards in the same order as GameState: player 0 gets the first 4 cards, ...
+        self.hands = self.decks[:, :n_players * N_CARDS].reshape(self.n_games, n_players, N_CARDS).copy()
+
+        self.stash_heights = np.zeros((self.n_games, len(COLORS)), dtype=np.int8)     # Highest placed number
+        self.discard_counts = np.zeros((self.n_games, N_CODES), dtype=np.int16)      # Discarded cards by code
+
+        self.current_player = np.zeros(self.n_games, dtype=np.int64)
+        self.action_done = np.zeros(self.n_games, dtype=bool)
+
+        self.info_points = np.full(self.n_games, MAX_INFO_POINTS, dtype=np.int8)
+        self.life_points = np.full(self.n_games, MAX_LIFE_POINTS, dtype=np.int8)
+        self.lost = np.zeros(self.n_games, dtype=bool)
+
+        self.version = np.zeros(self.n_games, dtype=np.int64)
+        self.games = np.arange(self.n_games)
+
+    @classmethod
+    def shuffled(cls, n_games, n_players, seed=None):
+        rng = np.random.default_rng(seed)
+        decks = rng.permuted(np.tile(DECK_CODES, (n_games, 1)), axis=1)
+        return cls(decks, n_players)
+
+    @classmethod
+    def from_game_states(cls, game_states):
+
+        """ Starts a batch from freshly dealt GameState objects, with the same deck order. """
+
+        decks = [[card.code for card in game_state.deck.cards] for game_state in game_states]
+        return cls(decks, game_states[0].n_players)
+
+    def deck_size(self):
+        return len(DECK_CODES) - self.deck_position
+
+    def scores(self):
+        return self.stash_heights.sum(axis=1)
+
+    def completed(self):
+        return (self.stash_heights == len(NUMBERS)).all(axis=1)
+
+    def step(self, actions, card_positions, players=None):
+
+        """ Applies one action to every game: actions[i] with card_positions[i] (used by BURN and PLACE) in
+        game i, done by players[i] (by default the current player of each game).
+
+        Returns a boolean array, True where the game state was updated, like GameState.update. """
+
+        games = self.games
+        actions = np.asarray(actions)
+        card_positions = np.asarray(card_positions, dtype=np.int64)
+        players = self.current_player if players is None else np.asarray(players, dtype=np.int64)
+
+        # Only accept actions from the current player:
+        turn = players == self.current_player
+        free = turn & ~self.action_done
+
+        # Card in the selected slot, for BURN and PLACE:
+        card = self.hands[games, players, card_positions]
+        color = CODE_COLOR[card]
+        has_card = card != 0
+
+        # When a player gives someone info:
+        info = free & (actions == INFO) & (self.info_points > 0)
+        self.info_points -= info
+
+        # When a player burns a card: get an info point back and move the card to the discard pile:
+        burn = free & (actions == BURN) & has_card
+        self.info_points = np.where(burn, np.minimum(self.info_points + 1, MAX_INFO_POINTS), self.info_points)
+
+        # When a player places a card: correct cards go on the table, wrong ones cost a life:
+        place = free & (actions == PLACE) & has_card
+        correct = place & (CODE_NUMBER[card] == self.stash_heights[games, color] + 1)
+        wrong = place & ~correct
+
+        self.stash_heights[games[correct], color[correct]] += 1
+        self.life_points = np.where(wrong, np.maximum(self.life_points - 1, 0), self.life_points)
+        self.lost |= wrong & (self.life_points == 0)
+
+        discarded = burn | wrong
+        np.add.at(self.discard_counts, (games[discarded], card[discarded]), 1)
+
+        # The used card leaves the player's hand:
+        used = burn | place
+        self.hands[games[used], players[used], card_positions[used]] = 0
+        self.action_done |= info | used
+
+        # When a player pulls a card, it goes into the first empty slot:
+        empty_slots = self.hands[games, players] == 0
+        pull = turn & (actions == PULL) & empty_slots.any(axis=1) & (self.deck_position < len(DECK_CODES))
+        pulled = games[pull]
+        slot = empty_slots[pull].argmax(axis=1)
+        self.hands[pulled, players[pull], slot] = self.decks[pulled, self.deck_position[pull]]
+        self.deck_position += pull
+
+        # When a player clicks next turn, an action has to be done and the player has to have all cards:
+        next_turn = turn & (actions == NEXT) & self.action_done & ~empty_slots.any(axis=1)
+        self.action_done &= ~next_turn
+        self.current_player = np.where(next_turn, (self.current_player + 1) % self.n_players, self.current_player)
+
+        changed = info | used | pull | next_turn
+        self.version += changed
+        return changed
+
+
+def random_actions(batch, rng):
+
+    """ A simple policy: do a random action (info when there are points, burn or place a random card),
+    then pull a card and end the turn. """
+
+    actions = rng.integers(INFO, PLACE + 1, size=batch.n_games)
+    actions = np.where((actions == INFO) & (batch.info_points == 0), BURN, actions)
+
+    hand = batch.hands[batch.games, batch.current_player]
+    needs_card = (hand == 0).any(axis=1)
+    actions = np.where(batch.action_done, np.where(needs_card, PULL, NEXT), actions)
+
+    card_positions = rng.integers(0, N_CARDS, size=batch.n_games)
+    return actions, card_positions
+
+
+def run(n_games, n_players, seed=None, max_steps=10000):
+
+    """ Plays n_games with the random policy until every game is lost, completed or out of cards.
+    Returns the batch and the elapsed seconds. """
+
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    batch = BatchGameState.shuffled(n_games, n_players, seed)
+
+    for _ in range(max_steps):
+        # A game ends when it is lost, completed, or the current player can no longer refill the hand:
+        hand = batch.hands[batch.games, batch.current_player]
+        stuck = batch.action_done & (hand == 0).any(axis=1) & (batch.deck_size() == 0)
+        if (batch.lost | batch.completed() | stuck).all():
+            break
+
+        actions, card_positions = random_actions(batch, rng)
+        batch.step(actions, card_positions)
+
+    return batch, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play many Hanabi games at once with a random policy')
+    parser.add_argument('--games', type=int, default=10000, help='number of games played at once')
+    parser.add_argument('--players', type=int, default=2, help='players per game')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the decks and the policy')
+    args = parser.parse_args()
+
+    batch, elapsed = run(args.games, args.players, args.seed)
+
+    print(f'Played {batch.n_games} games of {batch.n_players} players in {elapsed:.3f} s: '
+          f'{batch.n_games / elapsed:.0f} games/s, {batch.version.sum() / elapsed:.0f} updates/s')
+    print(f'Mean score: {batch.scores().mean():.2f}, lost: {batch.lost.mean():.1%}')
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import statistics
+import packets
+from threading import Thread
+from game_logic import Deck, GameState
+from packets import InfoUsed, CardBurned, CardPlaced, CardPull, NextTurn
+from rooms import Room
+
+''' Benchmarks of the hot paths: game logic, the packet codecs, broadcast fanout and the GUI state updates.
+Everything runs in one process, the fanout goes to sockets over loopback.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+
+Each benchmark reports the time per call in microseconds. With --baseline the results are compared to an
+earlier output file and the exit code is 1 if any benchmark got slower than the tolerance allows.'''
+
+PLAYERS = {0: 'Alice', 1: 'Bob', 2: 'Carol', 3: 'Dave'}
+
+
+def measure(func, setup=None, number=1000, repeat=7):
+
+    """ Calls func number times per repeat and returns the time per call of each repeat in seconds.
+    setup(number) prepares the arguments of the calls outside of the timing, func gets one argument per call. """
+
+    timings = []
+
+    for _ in range(repeat):
+        args = setup(number) if setup is not None else [None] * number
+
+        start = time.perf_counter()
+        for arg in args:
+            func(arg)
+        timings.append((time.perf_counter() - start) / len(args))
+
+    return timings
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return {'mean_us': statistics.mean(timings) * 1e6,
+            'median_us': statistics.median(timings) * 1e6,
+            'min_us': timings[0] * 1e6,
+            'max_us': timings[-1] * 1e6,
+            'repeat': len(timings)}
+
+
+# --- Game logic --- #
+
+def game_state_for(event_class, seed):
+
+    """ Returns a game state and an event of the given class that it accepts. """
+
+    game_state = GameState(4, seed)
+    game_state.started = True
+
+    if event_class is InfoUsed:
+        return game_state, InfoUsed(0)
+    if event_class is CardBurned:
+        return game_state, CardBurned(0, game_state.player_hands[0][1], 1)
+    if event_class is CardPlaced:
+        return game_state, CardPlaced(0, game_state.player_hands[0][1], 1)
+
+    game_state.update(CardBurned(0, game_state.player_hands[0][1], 1))
+    if event_class is CardPull:
+        return game_state, CardPull(0)
+
+    game_state.update(CardPull(0))
+    return game_state, NextTurn(0)
+
+
+def bench_game_logic(results):
+
+    def decks(number):
+        return [Deck(seed) for seed in range(number)]
+
+    def pull_all(deck):
+        while deck:
+            deck.pull_card()
+
+    # Every card of a deck is pulled per call:
+    n_cards = len(Deck(0).cards)
+    timings = measure(pull_all, decks, number=200)
+    results['Deck.pull_card'] = summary([t / n_cards for t in timings])
+
+    results['GameState.__init__ (4 players)'] = summary(measure(lambda seed: GameState(4, seed),
+                                                                 lambda number: range(number), number=500))
+
+    for event_class in (InfoUsed, CardBurned, CardPlaced, CardPull, NextTurn):
+        def setup(number, event_class=event_class):
+            return [game_state_for(event_class, seed) for seed in range(number)]
+
+        results[f'GameState.update({event_class.__name__})'] = summary(
+            measure(lambda arg: arg[0].update(arg[1]), setup, number=500))
+
+
+# --- Codecs --- #
+
+def played_game_state(n_events=12):
+
+    """ A 4 player game state a few turns into the game, with cards on the table and in the discard pile. """
+
+    game_state = GameState(4, seed=1)
+    game_state.started = True
+
+    for _ in range(n_events):
+        player = game_state.current_player
+        action = CardPlaced if game_state.version % 2 else CardBurned
+        game_state.update(action(player, game_state.player_hands[player][0], 0))
+        game_state.update(CardPull(player))
+        game_state.update(NextTurn(player))
+
+    return game_state
+
+
+def bench_codecs(results):
+    game_state = played_game_state()
+    game_state.update(InfoUsed(game_state.current_player))
+
+    for codec in packets.CODECS:
+        snapshot = game_state.to_bytes(PLAYERS, codec)
+        delta = game_state.last_delta.to_bytes(codec)
+        placed = CardPlaced(0, game_state.player_hands[0][0], 0)
+
+        results[f'GameStateUpdate encode ({codec})'] = summary(
+            measure(lambda _: game_state.to_bytes(PLAYERS, codec)))
+        results[f'GameStateUpdate decode ({codec})'] = summary(
+            measure(lambda _: packets.load(snapshot[packets.HEADER.size:])))
+        # Encoded and decoded again, the way they go from the sender to the receiver:
+        results[f'GameStateDelta round trip ({codec})'] = summary(
+            measure(lambda _: packets.load(game_state.last_delta.to_bytes(codec)[packets.HEADER.size:])))
+        results[f'CardPlaced round trip ({codec})'] = summary(
+            measure(lambda _: packets.load(placed.to_bytes(codec)[packets.HEADER.size:])))
+
+        results[f'GameStateUpdate size ({codec})'] = {'bytes': len(snapshot)}
+        results[f'GameStateDelta size ({codec})'] = {'bytes': len(delta)}
+
+
+# --- Broadcast fanout --- #
+
+class LoopbackClient:
+
+    """ A room client backed by a loopback TCP connection. A thread on the other end reads and drops the data. """
+
+    def __init__(self, listener, codec):
+        self.codec = codec
+        self.sock = socket.create_connection(listener.getsockname())
+        self.peer, _ = listener.accept()
+        self.thread = Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def send_game_state(self, data):
+        self.sock.sendall(data)
+
+    def drain(self):
+        while self.peer.recv(65536):
+            pass
+        self.peer.close()
+
+    def close(self):
+        # The draining thread stops at the end of the stream:
+        self.sock.close()
+        self.thread.join()
+
+
+def bench_fanout(results, n_clients):
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(n_clients)
+
+    for codec in packets.CODECS:
+        room = Room('benchmark', n_players=4)
+        room.GS = played_game_state()
+        room.players = PLAYERS
+        room.GS.update(InfoUsed(room.GS.current_player))
+        room.clients = {LoopbackClient(listener, codec) for _ in range(n_clients)}
+
+        def snapshot(_):
+            room.broadcast_cache.clear()
+            room.broadcast_game_state_update()
+
+        def delta(_):
+            room.broadcast_cache.clear()
+            room.broadcast_game_state_delta()
+
+        results[f'Room.broadcast_game_state_update ({n_clients} clients, {codec})'] = summary(
+            measure(snapshot, number=200))
+        results[f'Room.broadcast_game_state_delta ({n_clients} clients, {codec})'] = summary(
+            measure(delta, number=200))
+
+        for client in room.clients:
+            client.close()
+
+    listener.close()
+
+
+# --- GUI --- #
+
+def bench_game_window(results):
+    try:
+        from game_window import GameWindow
+        window = GameWindow(client=None)
+    except Exception as ex:
+        results['GameWindow.update_game_state (deltas)'] = {'skipped': f'{type(ex).__name__}: {ex}'}
+        return
+
+    # The states of a game turn by turn, as the client receives them:
+    game_state = GameState(4, seed=1)
+    game_state.started = True
+    states = [packets.load(game_state.to_bytes(PLAYERS, 'binary')[packets.HEADER.size:])]
+    for _ in range(10):
+        player = game_state.current_player
+        for event in (CardBurned(player, game_state.player_hands[player][0], 0), CardPull(player), NextTurn(player)):
+            game_state.update(event)
+            states.append(packets.load(game_state.last_delta.to_bytes('binary')[packets.HEADER.size:]))
+
+    window.player_id = 0
+
+    def setup(number):
+        # Every repeat starts a new game, without the card tabs of the last one:
+        window.reset_game()
+        window.update_server_state(states[0])
+        return states[1:]
+
+    results['GameWindow.update_game_state (deltas)'] = summary(
+        measure(window.apply_game_state_delta, setup, number=len(states) - 1))
+    window.close()
+
+
+# --- Comparison --- #
+
+def compare(results, baseline, tolerance):
+
+    """ Prints the change of every benchmark against the baseline. Returns the names of the regressions. """
+
+    regressions = []
+
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        if 'min_us' not in result or 'min_us' not in old:
+            continue
+
+        # The fastest repeat is the least disturbed by the rest of the machine:
+        ratio = result['min_us'] / old['min_us']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  <-- slower'
+            regressions.append(name)
+        print(f'{name:60s} {old["min_us"]:10.2f} us -> {result["min_us"]:10.2f} us  ({ratio:5.2f}x){flag}')
+
+    return regressions
+
+
+def run(n_clients):
+    results = {}
+
+    bench_game_logic(results)
+    bench_codecs(results)
+    bench_fanout(results, n_clients)
+    bench_game_window(results)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyHanabi benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline before it counts as a regression')
+    parser.add_argument('--clients', type=int, default=16, help='number of loopback clients for the fanout')
+    args = parser.parse_args()
+
+    results = run(args.clients)
+    output = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'benchmarks': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} benchmark(s) slower than the baseline.')
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import math
+import time
+import random
+import logging
+from collections import Counter
+from threading import Thread, Event
+from metrics import metrics
+from cards import EMPTY, UNKNOWN, card_from
+from game_logic import Deck, MirrorGameState
+from packets import InfoUsed, CardBurned, CardPlaced, CardPull, NextTurn, Turn
+from settings import BOT_TIME_BUDGET
+
+''' Bot players the server seats in rooms that wait too long for people (--bots-after SECONDS). A bot is a
+client of its room like a RequestHandler, without a socket: the broadcasts only wake up its thread, and its
+moves go through Room.handle_event like the Turns of the other players.
+
+A bot chooses its move with a Monte Carlo search over its information set. It sees the hands of the others,
+the table and the discard pile, but not its own hand. Each iteration of the search deals the cards it has not
+seen (its own hand and the deck) at random, plays one of its possible moves in that deal and then a few more
+turns with a random policy, all with the GameState rules, and scores the result. The moves are picked by UCB1
+until the time budget is used up, and the move with the best average score is played. The game state is
+rolled back with GameState.save() and restore() after every iteration instead of being copied.
+
+There are no hints about the cards in this version of the game, so a player knows nothing about their own cards
+and all the positions of the hand are alike. The search only compares giving info, placing and burning.'''
+
+logger = logging.getLogger(__name__)
+
+BOT_PREFIX = 'Bot '             # Names of the bots, a recovered game gives these seats to bots again
+ROLLOUT_TURNS = 2               # Turns played after the bot's move in every iteration
+LIFE_COST = 0.4                 # Score that losing a life point is worth
+LOSS_COST = 3.0                 # Score that losing the game is worth
+EXPLORATION = 1.0               # UCB1 exploration constant
+MAX_ITERATIONS = 50000          # Iterations of one search, even if there is time left
+
+# Every card of the game, the unseen cards are these minus the visible ones:
+ALL_CARDS = [card_from(col, num) for col in Deck.colors for num, count in Deck.deck_dict.items() for _ in range(count)]
+
+INFO, PLACE, BURN = 'info', 'place', 'burn'
+
+
+class SampledDeck:
+
+    """ The deck in the order of one deal of the unseen cards. It is used like the HiddenDeck of the
+    MirrorGameState, so the rules of the GameState work on it. """
+
+    deck_dict = Deck.deck_dict
+    colors = Deck.colors
+
+    def __init__(self):
+        self.cards = []
+        self.position = 0
+
+    def pull_card(self):
+        if self.position >= len(self.cards):
+            raise IndexError('Cannot pull a card from an empty deck.')
+        card = self.cards[self.position]
+        self.position += 1
+        return card
+
+    def __len__(self):
+        return len(self.cards) - self.position
+
+    def mark(self):
+        return self.position
+
+    def rewind(self, mark):
+        self.position = mark
+
+
+def score(game_state):
+    return sum(len(column) for column in game_state.table_stash.values())
+
+
+def turn_events(player_id, move, hand):
+
+    """ The events of a move: the action, a new card if one left the hand, and the end of the turn. """
+
+    kind, position = move
+    if kind == INFO:
+        events = [InfoUsed(player_id)]
+    elif kind == PLACE:
+        events = [CardPlaced(player_id, hand[position], position), CardPull(player_id)]
+    else:
+        events = [CardBurned(player_id, hand[position], position), CardPull(player_id)]
+    return events + [NextTurn(player_id)]
+
+
+def possible_moves(game_state, player_id):
+    moves = []
+    if game_state.info_points > 0:
+        moves.append((INFO, None))
+
+    # A card that leaves the hand has to be replaced before the turn can end:
+    positions = [position for position, card in game_state.player_hands[player_id].items() if card is not EMPTY]
+    if positions and len(game_state.deck):
+        moves += [(PLACE, positions[0]), (BURN, positions[0])]
+
+    return moves
+
+
+class InformationSetSearch:
+
+    """ The search for one move of one player. """
+
+    def __init__(self, game_state, player_id, rng=random):
+        self.player_id = player_id
+        self.rng = rng
+
+        # The game as the player sees it, with its own cards hidden. The search works on this MirrorGameState:
+        self.state = game_state
+        hand = self.state.player_hands[player_id]
+        self.own_positions = [position for position, card in hand.items() if card is not EMPTY]
+        for position in self.own_positions:
+            hand[position] = UNKNOWN
+
+        # The cards the player has not seen: its own hand and the deck:
+        unseen = Counter(ALL_CARDS)
+        for other, other_hand in self.state.player_hands.items():
+            if other != player_id:
+                unseen.subtract(card for card in other_hand.values() if card is not EMPTY)
+        for column in self.state.table_stash.values():
+            unseen.subtract(column)
+        unseen.subtract(self.state.discard_pile)
+        self.unseen = list(unseen.elements())
+
+        self.moves = possible_moves(self.state, player_id)
+
+        self.deck_size = len(self.state.deck)
+        self.state.deck = SampledDeck()
+        self.visits = [0] * len(self.moves)
+        self.totals = [0.0] * len(self.moves)
+        self.iterations = 0
+
+    def determinize(self):
+
+        """ Deals the unseen cards at random into the player's hand and the deck. """
+
+        self.rng.shuffle(self.unseen)
+        hand = self.state.player_hands[self.player_id]
+        for position, card in zip(self.own_positions, self.unseen):
+            hand[position] = card
+
+        self.state.deck.cards = self.unseen[len(self.own_positions):len(self.own_positions) + self.deck_size]
+        self.state.deck.position = 0
+
+    def select(self):
+
+        """ UCB1 over the moves, every move is tried once first. """
+
+        for index, visits in enumerate(self.visits):
+            if not visits:
+                return index
+
+        log_total = math.log(self.iterations)
+        return max(range(len(self.moves)), key=lambda index: self.totals[index] / self.visits[index] +
+                   EXPLORATION * math.sqrt(log_total / self.visits[index]))
+
+    def play_turn(self, player_id, move):
+        hand = self.state.player_hands[player_id]
+        return all(self.state.apply_event(event) for event in turn_events(player_id, move, hand))
+
+    def random_move(self, player_id):
+        moves = possible_moves(self.state, player_id)
+        if not moves:
+            return None
+
+        kind, _ = self.rng.choice(moves)
+        if kind == INFO:
+            return kind, None
+        hand = self.state.player_hands[player_id]
+        return kind, self.rng.choice([position for position, card in hand.items() if card is not EMPTY])
+
+    def rollout(self, move):
+
+        """ Plays the move and a few more turns in the current deal. Returns the score of the result. """
+
+        state = self.state
+        saved = state.save()
+        start_score, start_lives = score(state), state.life_points
+
+        try:
+            self.play_turn(self.player_id, move)
+
+            for _ in range(ROLLOUT_TURNS):
+                if state.lost:
+                    break
+                player_id = state.current_player
+                next_move = self.random_move(player_id)
+                if next_move is None or not self.play_turn(player_id, next_move):
+                    break
+
+            return (score(state) - start_score - LIFE_COST * (start_lives - state.life_points) -
+                    (LOSS_COST if state.lost else 0.0))
+        finally:
+            state.restore(saved)
+
+    def run(self, budget=BOT_TIME_BUDGET):
+
+        """ Searches until the budget in seconds is used up. Returns the best move, or None if there is none. """
+
+        if len(self.moves) <= 1:
+            return self.moves[0] if self.moves else None
+
+        deadline = time.perf_counter() + budget
+        while self.iterations < MAX_ITERATIONS and (self.iterations < len(self.moves) or
+                                                    time.perf_counter() < deadline):
+            self.determinize()
+            index = self.select()
+            self.totals[index] += self.rollout(self.moves[index])
+            self.visits[index] += 1
+            self.iterations += 1
+
+        best = max((index for index in range(len(self.moves)) if self.visits[index]),
+                   key=lambda index: self.totals[index] / self.visits[index])
+        return self.moves[best]
+
+
+def choose_turn(game_state, player_id, budget=BOT_TIME_BUDGET, rng=random):
+
+    """ The Turn of a bot for a MirrorGameState of its room, or None if it cannot move. The search changes the
+    game state. The events name the cards of the real hand, as the clients do; the search never looks at them. """
+
+    hand = dict(game_state.player_hands[player_id])
+    search = InformationSetSearch(game_state, player_id, rng)
+    move = search.run(budget)
+    if move is None:
+        return None
+
+    logger.debug('Bot %d plays %s after %d iterations.', player_id, move, search.iterations)
+    return Turn(player_id, turn_events(player_id, move, hand))
+
+
+class BotPlayer:
+
+    """ A seat filled by the server. The moves are searched on the bot's own thread, outside of the room lock,
+    so the room keeps serving the other players meanwhile. """
+
+    def __init__(self, server, user_name, budget=BOT_TIME_BUDGET):
+        self.server = server
+        self.user_name = user_name
+        self.budget = budget            # Seconds of search per move
+
+        self.codec = 'binary'
+        self.room = None
+        self.player_id = None
+
+        self.wake = Event()
+        self.running = True
+        self.tried_version = None       # Version of the game state the last Turn was sent for
+        self.rng = random.Random()
+        self.thread = Thread(target=self.run, name=f'bot-{user_name}', daemon=True)
+
+    def send_game_state(self, data):
+        # Any packet for the bot means the game state may have changed, it looks at the room itself:
+        self.wake.set()
+
+    def start(self, room, player_id):
+        self.room = room
+        self.player_id = player_id
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if not self.running:
+                return
+
+            with self.room.lock:
+                game_state = self.room.GS
+                if not game_state.started or game_state.lost or game_state.current_player != self.player_id:
+                    continue
+
+                # A Turn sent for this version was rejected, trying it again would not help:
+                if game_state.version == self.tried_version:
+                    continue
+
+                # The MirrorGameState copies the hands, the table and the discard pile of the room:
+                version = game_state.version
+                view = MirrorGameState(game_state.to_packet(self.room.players))
+
+            with metrics.timer('bot_move'):
+                turn = choose_turn(view, self.player_id, self.budget, self.rng)
+
+            if turn is None or not self.running:
+                continue
+
+            self.tried_version = version
+            self.server.call_soon(lambda turn=turn: self.room.handle_event(turn, self))
@@ -0,0 +1,57 @@
+''' This module defines the cards of Hanabi. There is a small fixed universe of cards: one for every color and
+number, plus the EMPTY placeholder for a free slot in a player's hand. Every card object is created once here
+and shared by everyone else, so cards can be compared by identity and cost nothing to store.
+
+Each card also has a small integer code (0 for EMPTY, 1..25 for the real cards) for compact encodings.'''
+
+COLORS = ['blue', 'red', 'green', 'yellow', 'white']
+NUMBERS = [1, 2, 3, 4, 5]
+
+
+class Card:
+
+    """ A single interned Hanabi card. Do not instantiate directly, use get_card() or card_from(). """
+
+    __slots__ = ('color', 'number', 'code')
+
+    def __init__(self, color, number, code):
+        self.color = color
+        self.number = number
+        self.code = code
+
+    def __repr__(self):
+        return f'Card({self.color}, {self.number})'
+
+    def __reduce__(self):
+        # Unpickling returns the interned card instead of a copy:
+        return get_card, (self.code, )
+
+    def to_dict(self):
+        return {"color": self.color, "number": self.number}
+
+
+# Placeholder for an empty slot in a player's hand:
+EMPTY = Card('empty', 0, 0)
+
+# Placeholder for a card the client has not been told yet, e.g. one it pulled before the server answered.
+# It is never sent over the network:
+UNKNOWN = Card('unknown', 0, 0)
+
+# The universe of cards, indexed by code:
+CARDS = [EMPTY] + [Card(col, num, 1 + i * len(NUMBERS) + j)
+                   for i, col in enumerate(COLORS)
+                   for j, num in enumerate(NUMBERS)]
+
+_CARDS_BY_KEY = {(card.color, card.number): card for card in CARDS}
+
+
+def get_card(code):
+    return CARDS[code]
+
+
+def card_from(color, number):
+    return _CARDS_BY_KEY[(color, number)]
+
+
+def card_from_dict(d):
+    return _CARDS_BY_KEY[(d["color"], d["number"])]
@@ -1,100 +1,245 @@
-import arcade
-import names
+import time
+STARTED = time.perf_counter()       # Taken before the other imports, the startup times are counted from here
+
+import logging
+import argparse
 import packets
-from game_window import GameWindow
-from threading import Thread
+from settings import HOST, PORT, LOG_LEVEL
+from log import setup_logging
+from threading import Thread, Event
 from socket import socket, AF_INET, SOCK_STREAM
 
+# arcade, the GUI modules and names are slow to import. They are imported in main() and on the startup threads,
+# so the connection to the server and the loading of the assets overlap with creating the window.
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+
+    """ Seconds from the start of the client to each step of the startup. The startup is over when the window
+    draws the first game state of the server: from then on the player can play. """
+
+    def __init__(self, started=STARTED):
+        self.started = started
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter() - self.started
+
+    def frame_drawn(self, game_window):
+
+        """ Called by the GameWindow after every frame, until the startup is over. """
+
+        if 'first_frame' not in self.marks:
+            self.mark('first_frame')
+
+        if game_window.GS is not None:
+            self.mark('interactive')
+            game_window.startup = None
+            self.report()
+
+    def report(self):
+        steps = ', '.join(f'{name} {seconds:.3f} s' for name, seconds in sorted(self.marks.items(), key=lambda m: m[1]))
+        logger.info('Startup: %s', steps)
+
+
+def preload_assets(startup):
+
+    """ Loads the card textures and the fonts, run on its own thread while the window is created. """
+
+    from gui_elements import card_textures, preload_fonts
+
+    card_textures.preload()
+    preload_fonts()
+    startup.mark('assets')
+
 
 class Client:
 
     """ Handles TCP connection to the game Server. After a connection handshake:
     -> Starts a thread that listens to game state updates and communicates with the GUI. """
 
-    def __init__(self, user_name='DefaultPlayerName'):
-        self.user_name = user_name
-        self.server_address = ('localhost', 10000)
+    def __init__(self, user_name=None, room='', server_address=(HOST, PORT), startup=None):
+        self.user_name = user_name                  # A random first name when None
+        self.room = room                            # Room to join, empty for any room waiting for players
+        self.server_address = server_address
 
         self.BUFFERSIZE = 4096
         self.sock = socket(AF_INET, SOCK_STREAM)
+        self.decoder = packets.PacketDecoder()      # Keeps partial packets between recv() calls
 
         self.connected = False
         self.player_id = 999
+        self.codec = 'json'                         # Codec confirmed by the server, used for sending events
+        self.resync_requested = False               # Waiting for a full game state after a missed delta
+
+        # The connection is made while the window is still being created, the broadcasts wait for it:
+        self.game_window = None
+        self.window_ready = Event()
+        self.startup = startup                      # StartupTimer of the client, if any
+
+    def attach(self, game_window):
+
+        """ Hands the window over to the connection thread once it exists. """
+
+        self.game_window = game_window
+        self.window_ready.set()
+
+    def run(self):
 
-    def connect_to_server(self, game_window: GameWindow, thread_receive_broadcast: Thread):
+        """ The connection thread: the handshake, then the broadcasts for the window until the connection ends. """
 
-        print(f'>>>> Attempting connection with user name: {self.user_name}')
+        try:
+            confirmation = self.connect_to_server()
+        except OSError as ex:
+            logger.error('Could not connect to the server at %s: %s', self.server_address, ex)
+            return
+
+        if confirmation is None:
+            return
+
+        self.window_ready.wait()
+        game_window = self.game_window
+        game_window.player_id = confirmation.player_id
+        game_window.connection = True
+        game_window.player_name = confirmation.user_name
+
+        logger.info('Joined room %s, receiving the broadcasts.', confirmation.room)
+        self.receive_game_state_broadcast(game_window)
+
+    def connect_to_server(self):
+
+        """ Connects and does the handshake. Returns the ConnectionConfirmed, or None if the server denied it. """
+
+        if self.user_name is None:
+            import names
+            self.user_name = names.get_first_name()
+
+        logger.info('Attempting connection with user name: %s', self.user_name)
         self.sock.connect(self.server_address)
 
         # After connecting: attempt a connection handshake to sync string user_names and integer player_id
-        con_attempt = packets.ConnectionAttempt(self.user_name)
-        self.sock.send(con_attempt.to_bytes())
+        con_attempt = packets.ConnectionAttempt(self.user_name, packets.CODECS, self.room)
+        self.sock.sendall(con_attempt.to_bytes())
+
+        # Wait for receiving a confirmation, anything after it stays in the decoder for the receive thread:
+        data = self.receive_packet()
 
-        # Wait for receiving a confirmation
-        data = self.sock.recv(self.BUFFERSIZE)
-        if data:
-            data = packets.load(data)
+        if self.startup is not None:
+            self.startup.mark('handshake')
 
-        # If confirmation received, start the thread that listens to server updates
         if type(data) is packets.ConnectionConfirmed and data.confirmed:
             self.connected = True
             self.player_id = data.player_id
+            self.codec = data.codec
+            self.room = data.room
+            return data
+
+        logger.warning('Connection denied.')
+        return None
 
-            game_window.player_id = data.player_id
-            game_window.connection = True
-            game_window.player_name = data.user_name
+    def receive_packet(self):
 
-            print('>>>> Connection to server successful. Starting broadcast receive thread.')
-            thread_receive_broadcast.start()
+        """ Returns the next packet from the server. Blocks until a whole packet has arrived.
+        Returns None when the connection is closed. """
+
+        while True:
+            packet = self.decoder.next_packet()
+            if packet is not None:
+                return packet
 
-        else:
-            print('Connection denied.')
+            data = self.sock.recv(self.BUFFERSIZE)
+            if not data:
+                return None
+            self.decoder.feed(data)
 
     def receive_game_state_broadcast(self, game_window):
 
         """ This is run as a separate thread to listen to game state updates from the server.
-        The state updates are forwarded to the game GUI. """
+        The state updates are decoded here and queued for the game GUI, which applies them in its update tick. """
 
         while True:
             try:
-                data = self.sock.recv(self.BUFFERSIZE)
+                data = self.receive_packet()
             except ConnectionAbortedError as ex:
-                print('Server connection was lost. Quitting for now. Exception thrown:', ex)
+                logger.error('Server connection was lost. Quitting for now. Exception thrown: %s', ex)
                 return -1
             except ConnectionResetError as ex:
-                print('Server connection was lost. Quitting for now. Exception thrown:', ex)
+                logger.error('Server connection was lost. Quitting for now. Exception thrown: %s', ex)
                 return -1
 
-            if not data:
-                continue
-
-            data = packets.load(data)
+            if data is None:
+                logger.error('Server closed the connection.')
+                return -1
 
             if type(data) is packets.GameStateUpdate:
                 data.keys_to_ints()
-                game_window.update_game_state(data)
+                self.resync_requested = False
+                game_window.update_queue.put(data)
+
+            elif type(data) in (packets.GameStateDelta, packets.EventRejected):
+                game_window.update_queue.put(data)
+
             else:
-                print(f'Received not GameStateUpdate broadcast with type: {type(data)}')
+                logger.warning('Received not GameStateUpdate broadcast with type: %s', type(data))
 
-    def send_game_event(self, event):
+    def request_resync(self, version):
 
-        """ Forwards a player event to the game server. """
-        print("Sending Event:", event)
-        self.sock.send(event)
+        """ Asks the server for a full game state update, once until it arrives. """
 
+        if self.resync_requested:
+            return
 
-def main():
+        logger.info('Missed a game state delta after version %d, requesting the full game state.', version)
+        self.resync_requested = True
+        self.sock.sendall(packets.ResyncRequest(version).to_bytes(self.codec))
 
-    # Instantaiate client and game GUI objects:
-    client = Client(user_name=names.get_first_name())
-    game_window = GameWindow(client=client)
+    def send_game_event(self, event):
 
-    # Communicate with server on separate threads:
-    thread_receive = Thread(target=client.receive_game_state_broadcast, args=(game_window, ), daemon=True)
-    thread_connect = Thread(target=client.connect_to_server, args=(game_window, thread_receive), daemon=True)
+        """ Encodes a player event and forwards it to the game server. """
+        logger.debug('Sending Event: %s', event)
+        self.sock.sendall(event.to_bytes(self.codec))
 
-    # The receive thread will be started once the connect thread is successful.
-    thread_connect.start()
+
+def main():
+    parser = argparse.ArgumentParser(description='PyHanabi game client')
+    parser.add_argument('--room', default='',
+                        help='room to join (letters, digits, - and _), by default any room waiting for players')
+    parser.add_argument('--host', default=HOST, help='address of the game server')
+    parser.add_argument('--port', type=int, default=PORT, help='port of the game server')
+    parser.add_argument('--log-level', default=LOG_LEVEL, help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the frames and show them in a HUD (F3: show/hide, F4: capture a profile)')
+    parser.add_argument('--capture-frames', type=int, default=None,
+                        help='number of frames profiled by one capture, 300 by default')
+    parser.add_argument('--capture-dir', default='.', help='directory of the captured profiles')
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    startup = StartupTimer()
+
+    # 1) Connect to the server and do the handshake, the broadcasts are received once the window is there:
+    client = Client(room=args.room, server_address=(args.host, args.port), startup=startup)
+    Thread(target=client.run, daemon=True).start()
+
+    # 2) Load the card textures and fonts:
+    Thread(target=preload_assets, args=(startup, ), daemon=True).start()
+
+    # 3) Meanwhile create the window, arcade has to stay on the main thread:
+    import arcade
+    from game_window import GameWindow
+    startup.mark('imports')
+
+    profiler = None
+    if args.profile:
+        from frame_profiler import FrameProfiler, CAPTURE_FRAMES
+        profiler = FrameProfiler(args.capture_frames or CAPTURE_FRAMES, args.capture_dir)
+
+    game_window = GameWindow(client=client, profiler=profiler)
+    game_window.startup = startup
+    startup.mark('window')
+    client.attach(game_window)
 
     # Run the arcade game engine
     arcade.run()
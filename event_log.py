@@ -0,0 +1,258 @@
+import os
+import re
+import time
+import logging
+import pickle
+import struct
+import packets
+from threading import Thread, Lock
+
+''' This module keeps the games of the server on disk, so they survive a crash of the server. Every room has
+two files in the log directory:
+
+    <room>.snapshot     The players and the whole GameState, pickled, written every SNAPSHOT_INTERVAL events.
+    <room>.log          The events accepted since that snapshot, appended in the order they were applied.
+
+A log record is framed like a packet on the network: a 4 byte length, then the version of the game state
+after the event and the event in the binary codec. Records are flushed to the OS right away, the fsync is
+done in batches by a background thread every SYNC_INTERVAL seconds.
+
+A snapshot is only pickled by the room. The same background thread writes it, syncs it and then removes the
+records it covers from the log, so recovering a game replays about SNAPSHOT_INTERVAL events no matter how
+long the game is. Until the new snapshot is on disk, the old one and the whole log are kept.'''
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = 50      # Events between two snapshots of a game
+SYNC_INTERVAL = 0.05        # Seconds between the fsyncs of the logs with new records
+
+# Version of the game state after the event, in front of each record:
+VERSION = struct.Struct('!i')
+
+# Room names come from the clients and end up in file names, only these are accepted:
+ROOM_NAME = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def valid_room_name(name):
+    return ROOM_NAME.fullmatch(name) is not None
+
+
+def write_file(path, data):
+
+    """ Replaces the file with the data: written to a temporary file, synced, renamed over the file, and the
+    rename synced as well. """
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+    # Directories cannot be opened for an fsync on Windows, there the rename is left to the file system:
+    if os.name != 'nt':
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class EventLog:
+
+    """ The event log and the snapshot of one room. """
+
+    def __init__(self, directory, name):
+        if not valid_room_name(name):
+            raise ValueError(f'Room name {name!r} cannot be used as a file name.')
+
+        self.log_path = os.path.join(directory, f'{name}.log')
+        self.snapshot_path = os.path.join(directory, f'{name}.snapshot')
+
+        self.lock = Lock()
+        self.sync_lock = Lock()             # One snapshot write at a time, and none after close()
+        self.file = open(self.log_path, 'ab')
+        self.size = self.file.tell()        # Bytes in the log, the file position is not kept up in append mode
+        self.dirty = False                  # Records written since the last fsync
+        self.events_since_snapshot = 0
+        self.pending_snapshot = None        # (pickled snapshot, size of the log when it was taken) to write
+
+    def append(self, version, event):
+
+        """ Writes an accepted event. Returns True when it is time for a new snapshot. """
+
+        record = packets.frame(VERSION.pack(version) + event.to_binary())
+
+        with self.lock:
+            self.file.write(record)
+            self.file.flush()
+            self.size += len(record)
+            self.dirty = True
+            self.events_since_snapshot += 1
+            return self.events_since_snapshot >= SNAPSHOT_INTERVAL
+
+    def write_snapshot(self, players, game_state):
+
+        """ Takes a snapshot of the given state. Only the pickling is done here, the sync thread writes it
+        and then drops the records it covers from the log. """
+
+        data = pickle.dumps({'players': players, 'game_state': game_state}, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            # A snapshot that was not written yet is replaced, the new one covers more of the log:
+            self.pending_snapshot = (data, self.size)
+            self.events_since_snapshot = 0
+
+    def replace_snapshot(self, data, log_size):
+
+        """ Replaces the snapshot on disk and removes the first log_size bytes of the log. Both files are
+        written next to the old ones, synced and then renamed over them, so a crash at any point leaves a
+        complete snapshot and every synced record on disk. """
+
+        write_file(self.snapshot_path, data)
+
+        # The records appended after the snapshot was taken are kept:
+        with self.lock:
+            with open(self.log_path, 'rb') as f:
+                f.seek(log_size)
+                rest = f.read()
+
+            self.file.close()
+            write_file(self.log_path, rest)
+            self.file = open(self.log_path, 'ab')
+            self.size = len(rest)
+            self.dirty = False
+
+            if self.pending_snapshot is not None:
+                data, pending_size = self.pending_snapshot
+                self.pending_snapshot = (data, pending_size - log_size)
+
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                if self.file.closed:
+                    return
+                pending, self.pending_snapshot = self.pending_snapshot, None
+
+            if pending is not None:
+                self.replace_snapshot(*pending)
+
+            with self.lock:
+                if self.dirty:
+                    os.fsync(self.file.fileno())
+                    self.dirty = False
+
+    def close(self, delete=False):
+        # A snapshot that is being written finishes first, so it cannot come back after the files are deleted:
+        with self.sync_lock:
+            if not delete:
+                with self.lock:
+                    pending, self.pending_snapshot = self.pending_snapshot, None
+                if pending is not None:
+                    self.replace_snapshot(*pending)
+
+            with self.lock:
+                self.file.close()
+
+        if delete:
+            for path in (self.log_path, self.snapshot_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def read_records(path):
+
+    """ Returns the (version, event) records of a log file. A record that was only partly written when the
+    server stopped is left out. """
+
+    if not os.path.exists(path):
+        return []
+
+    decoder = packets.PacketDecoder()
+    with open(path, 'rb') as f:
+        decoder.feed(f.read())
+
+    records = []
+    while True:
+        payload = decoder.next_payload()
+        if payload is None:
+            return records
+
+        (version, ) = VERSION.unpack_from(payload)
+        records.append((version, packets.load(payload[VERSION.size:])))
+
+
+def recover_game(directory, name):
+
+    """ Rebuilds the game of a room from its latest snapshot and the events logged after it.
+    Returns the players and the GameState. """
+
+    with open(os.path.join(directory, f'{name}.snapshot'), 'rb') as f:
+        snapshot = pickle.load(f)
+
+    game_state = snapshot['game_state']
+
+    for version, event in read_records(os.path.join(directory, f'{name}.log')):
+        # Written before the snapshot was, e.g. when the server stopped before truncating the log:
+        if version <= game_state.version:
+            continue
+
+        if not game_state.update(event) or game_state.version != version:
+            logger.warning('Event log of room %s does not match its snapshot at version %d, stopping there.',
+                           name, version)
+            break
+
+    return snapshot['players'], game_state
+
+
+class EventLogStore:
+
+    """ The event logs of all the rooms of a server, in one directory, and the thread that syncs them. """
+
+    def __init__(self, directory, sync_interval=SYNC_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync_interval = sync_interval
+
+        self.logs = {}
+        self.lock = Lock()
+
+        self.sync_thread = Thread(target=self.sync_loop, daemon=True)
+        self.sync_thread.start()
+
+    def open(self, name):
+        with self.lock:
+            log = self.logs[name] = EventLog(self.directory, name)
+        return log
+
+    def close(self, name, delete=False):
+        with self.lock:
+            log = self.logs.pop(name, None)
+        if log is not None:
+            log.close(delete)
+
+    def sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            with self.lock:
+                logs = list(self.logs.values())
+            for log in logs:
+                log.sync()
+
+    def recover(self):
+
+        """ Returns the (name, players, game_state) of every game found in the directory. """
+
+        games = []
+        filenames = set(os.listdir(self.directory))
+        for filename in sorted(filenames):
+            if filename.endswith('.snapshot'):
+                name = filename[:-len('.snapshot')]
+                players, game_state = recover_game(self.directory, name)
+                games.append((name, players, game_state))
+
+            # A game that stopped before its first snapshot was written cannot be recovered, and its records
+            # must not end up in the log of a new room with the same name:
+            elif filename.endswith('.log') and filename[:-len('.log')] + '.snapshot' not in filenames:
+                os.remove(os.path.join(self.directory, filename))
+        return games
@@ -0,0 +1,169 @@
+import os
+import time
+import logging
+import cProfile
+import tracemalloc
+from collections import deque
+import arcade
+from gui_elements import TextLabel, card_textures
+from settings import SCREEN_HEIGHT, MARGIN
+
+''' Opt-in frame profiler of the client (python client_socketserver.py --profile). The GameWindow reports to it
+
+    draw        the time spent in on_draw, without the HUD itself
+    update      the time spent applying the queued broadcasts, in the ticks that had any
+    latency     from the receive thread reading a broadcast to the end of the first frame that shows it
+
+The last WINDOW_FRAMES samples of each are kept and their percentiles are drawn in the top left corner of the
+window. F3 shows and hides the HUD. F4 runs cProfile and tracemalloc for the next `capture_frames` frames and
+writes the results to the capture directory:
+
+    frames-<time>.prof      cProfile stats, e.g. python -m pstats frames-<time>.prof
+    frames-<time>.txt       the top allocations of the captured frames by line'''
+
+logger = logging.getLogger(__name__)
+
+WINDOW_FRAMES = 300         # Samples kept for the rolling percentiles
+HUD_REFRESH = 0.5           # Seconds between two updates of the HUD text
+CAPTURE_FRAMES = 300        # Frames profiled by one capture
+TOP_ALLOCATIONS = 25        # Lines of the tracemalloc report
+
+SERIES = ('draw', 'update', 'latency')
+
+
+def percentiles(samples, ps=(50, 90, 99)):
+
+    """ Nearest rank percentiles of the samples, in the order of ps. """
+
+    ordered = sorted(samples)
+    if not ordered:
+        return [0.0 for _ in ps]
+    return [ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] for p in ps]
+
+
+class FrameCapture:
+
+    """ cProfile and tracemalloc running over a number of frames. """
+
+    def __init__(self, frames):
+        self.frames_left = frames
+        self.frames = frames
+        self.profile = cProfile.Profile()
+
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        self.profile.enable()
+
+    def finish(self, directory):
+
+        """ Stops the capture and writes it. Returns the path of the cProfile stats. """
+
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, time.strftime('frames-%Y%m%d-%H%M%S'))
+
+        self.profile.dump_stats(base + '.prof')
+
+        with open(base + '.txt', 'w') as f:
+            f.write(f'Top allocations over {self.frames} frames:\n')
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                f.write(f'{stat}\n')
+
+        return base + '.prof'
+
+
+class FrameProfiler:
+
+    """ Rolling frame timings of a GameWindow and the HUD showing them. """
+
+    def __init__(self, capture_frames=CAPTURE_FRAMES, capture_dir='.', show_hud=True):
+        self.capture_frames = capture_frames
+        self.capture_dir = capture_dir
+        self.show_hud = show_hud
+
+        self.samples = {name: deque(maxlen=WINDOW_FRAMES) for name in SERIES}
+        self.frame_ends = deque(maxlen=WINDOW_FRAMES)
+        self.received = []              # Receive times of the broadcasts applied but not drawn yet
+        self.capture = None
+
+        self.last_refresh = 0.0
+        self.labels = [TextLabel('', MARGIN, SCREEN_HEIGHT - MARGIN - 14 * i, font_size=9, anchor_x='left',
+                                 anchor_y='top') for i in range(len(SERIES) + 2)]
+
+    def updates_applied(self, start, received):
+
+        """ Called after the queued broadcasts were applied, with the time the work started and the receive
+        times of the broadcasts. """
+
+        if received:
+            self.samples['update'].append(time.perf_counter() - start)
+            self.received.extend(received)
+
+    def frame_drawn(self, start):
+
+        """ Called at the end of on_draw, with the time the frame started. """
+
+        now = time.perf_counter()
+        self.samples['draw'].append(now - start)
+        self.frame_ends.append(now)
+
+        if self.received:
+            self.samples['latency'].extend(now - received for received in self.received)
+            self.received = []
+
+        if self.capture is not None:
+            self.capture.frames_left -= 1
+            if self.capture.frames_left <= 0:
+                self.finish_capture()
+
+    def start_capture(self, frames=None):
+        if self.capture is not None:
+            return
+        self.capture = FrameCapture(frames or self.capture_frames)
+        logger.info('Profiling the next %d frames.', self.capture.frames)
+
+    def finish_capture(self):
+        capture, self.capture = self.capture, None
+        path = capture.finish(self.capture_dir)
+        logger.info('Wrote the profile of %d frames to %s', capture.frames, path)
+
+    def fps(self):
+        if len(self.frame_ends) < 2:
+            return 0.0
+        return (len(self.frame_ends) - 1) / (self.frame_ends[-1] - self.frame_ends[0])
+
+    def hud_lines(self):
+        lines = [f'{self.fps():5.1f} fps, {len(card_textures.textures)} textures loaded']
+
+        for name in SERIES:
+            samples = self.samples[name]
+            p50, p90, p99 = (value * 1000 for value in percentiles(samples))
+            lines.append(f'{name:8s} p50 {p50:6.2f}  p90 {p90:6.2f}  p99 {p99:6.2f} ms  (n={len(samples)})')
+
+        lines.append(f'capturing, {self.capture.frames_left} frames left' if self.capture is not None else '')
+        return lines
+
+    def draw(self):
+        if not self.show_hud:
+            return
+
+        # The text textures are only rebuilt a few times a second:
+        now = time.perf_counter()
+        if now - self.last_refresh >= HUD_REFRESH:
+            self.last_refresh = now
+            for label, line in zip(self.labels, self.hud_lines()):
+                label.set_text(line)
+
+        for label in self.labels:
+            label.draw()
+
+    def on_key_press(self, key, modifiers):
+        if key == arcade.key.F3:
+            self.show_hud = not self.show_hud
+        elif key == arcade.key.F4:
+            self.start_capture()
@@ -1,77 +1,110 @@
 import random
-from packets import GameStateUpdate, CardPlaced, CardBurned, CardPull, InfoUsed, NextTurn
+import logging
+from cards import COLORS, EMPTY, UNKNOWN, card_from
+from packets import GameStateUpdate, GameStateDelta, CardPlaced, CardBurned, CardPull, InfoUsed, NextTurn, Turn
+
+logger = logging.getLogger(__name__)
+
+# The first event of a Turn, the one action a player does in their turn:
+TURN_ACTIONS = (InfoUsed, CardBurned, CardPlaced)
 
 
 class Deck:
 
     """ A Class representation of a literal deck of cards from the game Hanabi. Cards have numbers and colors.
     The game server generates a deck at the start. The players can pull cards out and the game state
-    can keep track of the number of cards left within the deck."""
+    can keep track of the number of cards left within the deck.
 
-    def __init__(self):
-        # Store card objects (dictionaries with fields color and number:
-        self.cards = []
+    The cards are shuffled once into a preallocated list using a per-game seeded RNG. Pulling a card only moves
+    a cursor forward, and the number of cards left per color is updated as each card leaves the deck."""
 
-        # Structure of the deck:
-        self.deck_dict = {1: 3,     # Number of ones
-                          2: 2,     # Number of twos
-                          3: 2,     # Number of threes
-                          4: 2,     # Number of fours
-                          5: 1}     # Number of fives
+    # Structure of the deck:
+    deck_dict = {1: 3,     # Number of ones
+                 2: 2,     # Number of twos
+                 3: 2,     # Number of threes
+                 4: 2,     # Number of fours
+                 5: 1}     # Number of fives
 
-        # Available colors:
-        self.colors = ['blue', 'red', 'green', 'yellow', 'white']
+    # Available colors:
+    colors = COLORS
+
+    def __init__(self, seed=None):
+        # Seed of the shuffle, kept so that the same deck can be generated again:
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # Store card objects (interned Card objects from the cards module):
+        self.cards = []
 
         # Generate Cards:
         for col in self.colors:                             # For a given color col
             for num, count in self.deck_dict.items():       # For a given number num
-                for _ in range(count):                      # Generate a card a number of times given by deck_dict
-                    c = {"color": col,
-                         "number": num}
-                    self.cards.append(c)
+                for _ in range(count):                      # Add a card a number of times given by deck_dict
+                    self.cards.append(card_from(col, num))
+
+        # Shuffle once, pulling a card then just reads the next one:
+        self.rng.shuffle(self.cards)
+        self.position = 0                                   # Index of the next card to be pulled
+
+        # Number of cards left in the deck for each color:
+        self.color_counts = dict.fromkeys(self.colors, 0)
+        for card in self.cards:
+            self.color_counts[card.color] += 1
 
-        # Printable form of cards list:
-        self.deck_state = {}
-        self.update_state()
+    @property
+    def deck_state(self):
+        # Printable form of cards list, only built when asked for:
+        return {col: self.get_cards_with_color(col) for col in self.colors}
 
-    def update_state(self):
-        for col in self.colors:
-            self.deck_state[col] = self.get_cards_with_color(col)
+    def remaining_cards(self):
+        return self.cards[self.position:]
 
     def pull_card(self):
-        card = random.choice(self.cards)
-        self.cards.remove(card)
-        self.update_state()
+        if self.position >= len(self.cards):
+            raise IndexError('Cannot pull a card from an empty deck.')
+
+        card = self.cards[self.position]
+        self.position += 1
+        self.color_counts[card.color] -= 1
         return card
 
+    def __len__(self):
+        return len(self.cards) - self.position
+
+    def mark(self):
+        return self.position
+
+    def rewind(self, mark):
+        # Put the cards pulled since mark() back on top of the deck:
+        for card in self.cards[mark:self.position]:
+            self.color_counts[card.color] += 1
+        self.position = mark
+
     def __str__(self):
         return str(self.deck_state)
 
     # Returns all cards within the deck with color: col
     def get_cards_with_color(self, col):
-        cards_with_color = []
-        for card in self.cards:
-            if card["color"] == col:
-                cards_with_color.append(card)
-        return cards_with_color
+        return [card for card in self.remaining_cards() if card.color == col]
 
 
 class TableStashColumn(list):
     def max(self):
-        try:
-            return max(self)
-        except ValueError:
-            return 0
+        # Cards of one color are placed in order, so the last one is the highest:
+        return self[-1].number if self else 0
 
 
 class GameState:
-    def __init__(self, n_players):
+    def __init__(self, n_players, seed=None):
         self.n_players = n_players                                  # Number of players
         n_cards = 4                                                 # Number of cards in one player's hands
 
-        self.deck = Deck()                                          # Cards still in the deck
-        self.table_stash = dict.fromkeys(self.deck.colors,
-                                         TableStashColumn())        # Cards placed on the table
+        self.deck = Deck(seed)                                      # Cards still in the deck
+        self.seed = self.deck.seed                                  # Seed of the deck shuffle
+        self.table_stash = {col: TableStashColumn()
+                            for col in self.deck.colors}            # Cards placed on the table
         self.discard_pile = []                                      # Cards burned/discarded
 
         assert 2 <= n_players <= 4
@@ -98,23 +131,54 @@ class GameState:
         self.started = False
         self.lost = False
 
-    def to_bytes(self, players):
+        # Every successful update increases the version, the clients use it to apply the deltas in order:
+        self.version = 0
+        self.last_delta = None                                      # GameStateDelta of the last successful update
+
+        # Changes made by the event that is being applied:
+        self._hand_changes = []
+        self._table_added = []
+        self._discard_added = []
+
+    def to_packet(self, players):
 
         """ This function converts the necessary game state variables into a DataPacket object from packets."""
 
-        game_state_update = GameStateUpdate(started=self.started,
-                                            players=players,
-                                            player_hands=self.player_hands,
-                                            table_stash=self.table_stash,
-                                            discard_pile=self.discard_pile,
-                                            info_points=self.info_points,
-                                            life_points=self.life_points,
-                                            current_player=self.current_player)
+        return GameStateUpdate(started=self.started,
+                               players=players,
+                               player_hands=self.player_hands,
+                               table_stash=self.table_stash,
+                               discard_pile=self.discard_pile,
+                               info_points=self.info_points,
+                               life_points=self.life_points,
+                               current_player=self.current_player,
+                               version=self.version)
+
+    def to_bytes(self, players, codec='json'):
+
+        """ Encodes the game state update packet with the given codec."""
 
-        return game_state_update.to_bytes()
+        return self.to_packet(players).to_bytes(codec)
+
+    def set_hand_card(self, player, card_position, card):
+        self.player_hands[player][card_position] = card
+        self._hand_changes.append((player, card_position, card))
+
+    def add_to_table(self, card):
+        self.table_stash[card.color].append(card)
+        self._table_added.append(card)
+
+    def add_to_discard_pile(self, card):
+        self.discard_pile.append(card)
+        self._discard_added.append(card)
+
+    def completed(self):
+        # Every color has been placed up to the highest number:
+        return all(column.max() == max(self.deck.deck_dict) for column in self.table_stash.values())
 
     def lose_life_point(self):
-        self.life_points -= 1
+        # Cannot go below 0 life points
+        self.life_points = max(self.life_points-1, 0)
 
         if self.life_points == 0:
             self.lost = True
@@ -140,13 +204,86 @@ class GameState:
 
         Returns True on successful update to GameState.       -> denotes 'changed = True' bool
         Returns False, when event request is not possible.    -> denotes 'changed = False' bool, no need to broadcast
+
+        After a successful update the version is increased and last_delta holds the changes made by the event.
         """
 
+        changed = bool(self.apply_event(event))
+
+        if changed:
+            self.version += 1
+            self.last_delta = GameStateDelta(version=self.version,
+                                             hand_changes=self._hand_changes,
+                                             table_added=self._table_added,
+                                             discard_added=self._discard_added,
+                                             info_points=self.info_points,
+                                             life_points=self.life_points,
+                                             current_player=self.current_player)
+
+        self._hand_changes = []
+        self._table_added = []
+        self._discard_added = []
+
+        return changed
+
+    def save(self):
+
+        """ Returns what is needed to undo the events applied after it, see restore(). """
+
+        return (self.info_points, self.life_points, self.current_player, self.action_done, self.lost,
+                {player: dict(hand) for player, hand in self.player_hands.items()},
+                {col: len(column) for col, column in self.table_stash.items()},
+                len(self.discard_pile), self.deck.mark(),
+                len(self._hand_changes), len(self._table_added), len(self._discard_added))
+
+    def restore(self, saved):
+        (self.info_points, self.life_points, self.current_player, self.action_done, self.lost,
+         self.player_hands, table_sizes, discard_size, deck_mark,
+         n_hand_changes, n_table_added, n_discard_added) = saved
+
+        for col, size in table_sizes.items():
+            del self.table_stash[col][size:]
+        del self.discard_pile[discard_size:]
+        self.deck.rewind(deck_mark)
+
+        del self._hand_changes[n_hand_changes:]
+        del self._table_added[n_table_added:]
+        del self._discard_added[n_discard_added:]
+
+    def apply_turn(self, turn):
+
+        """ Applies the events of a Turn as one transaction: all of them, or none if any one is not possible. """
+
+        # A whole turn: one action, the card pulled if one left the hand, then the end of the turn:
+        kinds = [type(event) for event in turn.events]
+        if not kinds or kinds[0] not in TURN_ACTIONS or kinds[1:-1] not in ([], [CardPull]) \
+                or kinds[-1] is not NextTurn:
+            logger.debug('Turn rejected, not a whole turn: %s', [kind.__name__ for kind in kinds])
+            return False
+
+        saved = self.save()
+
+        for event in turn.events:
+            if event.player != turn.player or type(event) is Turn or not self.apply_event(event):
+                logger.debug('Turn rejected, rolling back.')
+                self.restore(saved)
+                return False
+
+        return True
+
+    def apply_event(self, event):
+
+        """ Applies the rules of the game for one event. Use update() instead, it also records the changes. """
+
         # Only accept events from the current player:
         if self.current_player != event.player:
-            print('Not this players turn.')
+            logger.debug('Not this players turn.')
             return False
 
+        # All the events of a turn at once:
+        if type(event) is Turn:
+            return self.apply_turn(event)
+
         # When a player gives someone info:
         if type(event) is InfoUsed and not self.action_done:
 
@@ -160,54 +297,65 @@ class GameState:
                 self.action_done = True
 
                 # Successful Update of GameState:
-                print('Info point taken')
+                logger.debug('Info point taken')
                 return True
             else:
-                print('No info left to do that.')
+                logger.debug('No info left to do that.')
                 return False
 
         # When a player burns a card:
         elif type(event) is CardBurned and not self.action_done:
 
+            # The card is looked up in the player's hand, an empty slot cannot be burned:
+            card = self.player_hands[event.player][event.card_position]
+            if card is EMPTY:
+                logger.debug('No card in this slot.')
+                return False
+
             # Get an info point back:
             self.add_info_point()
 
             # Remove the card from the player's hand:
-            self.player_hands[event.player][event.card_position] = {"color": 'empty', "number": 0}
+            self.set_hand_card(event.player, event.card_position, EMPTY)
 
             # Add that card to the discard pile:
-            self.discard_pile.append(event.card)
+            self.add_to_discard_pile(card)
 
             # Did a valid action this turn:
             self.action_done = True
 
             # Successful Update of GameState:
-            print(f'Card burned: {event.card}, info gained.')
+            logger.debug('Card burned: %s, info gained.', card)
 
             return True
 
         # When a player places a card on the table:
         elif type(event) is CardPlaced and not self.action_done:
 
+            # The card is looked up in the player's hand, an empty slot cannot be placed:
+            card = self.player_hands[event.player][event.card_position]
+            if card is EMPTY:
+                logger.debug('No card in this slot.')
+                return False
+
             # Check whether for this color, this number is correct:
             # If yes: -> add card to table stash;
-            if event.card["number"] == self.table_stash[event.card["color"]].max() + 1:
+            if card.number == self.table_stash[card.color].max() + 1:
 
-                self.table_stash = {key: [*lst, event.card] if event.card["color"] == key else lst
-                                    for key, lst in self.table_stash.items()}
+                self.add_to_table(card)
 
-                print(f'Correct card placed: {event.card}')
+                logger.debug('Correct card placed: %s', card)
 
             # If not: -> add card to discard pile and lose a life.
             else:
 
-                self.discard_pile.append(event.card)
+                self.add_to_discard_pile(card)
                 self.lose_life_point()
 
-                print('Wrong card placement, life lost')
+                logger.debug('Wrong card placement, life lost')
 
             # Take the card out of the player's hand:
-            self.player_hands[event.player][event.card_position] = {"color": 'empty', "number": 0}
+            self.set_hand_card(event.player, event.card_position, EMPTY)
 
             # Did a valid action this turn:
             self.action_done = True
@@ -218,17 +366,22 @@ class GameState:
         # When a player pulls a card:
         elif type(event) is CardPull:
 
+            # No cards left to pull:
+            if not self.deck:
+                logger.debug('Deck is empty. Cannot pull card.')
+                return False
+
             # Search for the empty slot in a player's hand and pull a card into it:
             for card_position, card in self.player_hands[event.player].items():
-                if card["color"] == "empty":
-                    self.player_hands[event.player][card_position] = self.deck.pull_card()
+                if card is EMPTY:
+                    self.set_hand_card(event.player, card_position, self.deck.pull_card())
 
                     # Successful Card Pull and update to GameState:
-                    print('New card pulled.')
+                    logger.debug('New card pulled.')
                     return True
 
             # The search for the card did not return, so the player has all cards already:
-            print('Player has all cards. Cannot pull card.')
+            logger.debug('Player has all cards. Cannot pull card.')
             return False
 
         # When a player clicks next turn:
@@ -237,7 +390,7 @@ class GameState:
             # Next Turn is only possible if an action has already been done and the player has all cards:
 
             # Check if the player has all cards:
-            has_all_cards = None not in self.player_hands[event.player].values()
+            has_all_cards = EMPTY not in self.player_hands[event.player].values()
 
             if self.action_done and has_all_cards:
 
@@ -246,8 +399,74 @@ class GameState:
 
                 # rotate through 0->1->...->(n_players - 1)->0
                 self.current_player = (self.current_player + 1) % self.n_players
-                print('Switched to Next Player')
+                logger.debug('Switched to Next Player')
                 return True
             else:
-                print('Current Player has not done any of: [Place, Info, Burn]')
+                logger.debug('Current Player has not done any of: [Place, Info, Burn]')
                 return False
+
+
+class HiddenDeck:
+
+    """ The deck as the clients see it: only the number of cards left is known. Pulled cards are UNKNOWN until
+    the server tells which card it was. """
+
+    deck_dict = Deck.deck_dict
+    colors = Deck.colors
+
+    def __init__(self, size):
+        self.size = size
+
+    def pull_card(self):
+        if not self.size:
+            raise IndexError('Cannot pull a card from an empty deck.')
+        self.size -= 1
+        return UNKNOWN
+
+    def __len__(self):
+        return self.size
+
+    def mark(self):
+        return self.size
+
+    def rewind(self, mark):
+        self.size = mark
+
+
+class MirrorGameState(GameState):
+
+    """ The client's copy of a GameStateUpdate, used to predict the result of the player's own events with the
+    same rules as the server. The update packet has no action_done flag, the client keeps track of it. """
+
+    def __init__(self, game_state_update, action_done=False):
+        n_players = len(game_state_update.player_hands)
+        table_stash = game_state_update.table_stash
+        discard_pile = game_state_update.discard_pile
+
+        # Every card that is not in a hand, on the table or in the discard pile is still in the deck:
+        n_cards = sum(len(Deck.colors) * count for count in Deck.deck_dict.values())
+        in_hands = sum(card is not EMPTY for hand in game_state_update.player_hands.values() for card in hand.values())
+        on_table = sum(len(column) for column in table_stash.values())
+        self.deck = HiddenDeck(n_cards - in_hands - on_table - len(discard_pile))
+
+        self.n_players = n_players
+        self.seed = None
+        self.table_stash = {col: TableStashColumn(table_stash.get(col, ())) for col in self.deck.colors}
+        self.discard_pile = list(discard_pile)
+        self.player_hands = {player: dict(hand) for player, hand in game_state_update.player_hands.items()}
+
+        self.current_player = game_state_update.current_player
+        self.action_done = action_done
+
+        self.info_points = game_state_update.info_points
+        self.life_points = game_state_update.life_points
+
+        self.started = game_state_update.started
+        self.lost = self.life_points == 0
+
+        self.version = game_state_update.version
+        self.last_delta = None
+
+        self._hand_changes = []
+        self._table_added = []
+        self._discard_added = []
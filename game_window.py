@@ -1,17 +1,53 @@
 import arcade
 import time
-from packets import GameStateUpdate, CardPlaced, CardBurned, CardPull, InfoUsed, NextTurn
-from gui_elements import NameTab, TextButton, CardTab, CardTabList
+from threading import Lock
+from cards import COLORS, EMPTY
+from game_logic import MirrorGameState
+from packets import GameStateUpdate, GameStateDelta, EventRejected, Turn, CardPlaced, CardBurned, CardPull, InfoUsed, \
+    NextTurn
+from gui_elements import NameTab, TextButton, TextLabel, CardTab, CardTabList, WidgetBatch
 from settings import *
 
 
+class UpdateQueue:
+
+    """ Game state broadcasts handed over from the network thread to the GUI thread, which applies them in its
+    update tick. A full game state replaces the game states and deltas queued before it, so a burst of
+    broadcasts costs at most one full update plus the deltas that arrived after it. Rejections are kept, the
+    window still has to drop the predictions they reject. Each packet is queued with the time it was received,
+    for the latency of the frame profiler. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = []               # (packet, time.perf_counter() when it was received)
+
+    def put(self, packet):
+        received = time.perf_counter()
+        with self.lock:
+            if type(packet) is GameStateUpdate:
+                self.pending = [queued for queued in self.pending if type(queued[0]) is EventRejected]
+            self.pending.append((packet, received))
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return pending
+
+
 class GameWindow(arcade.Window):
-    def __init__(self, client):
+    def __init__(self, client, profiler=None):
         super().__init__(width=SCREEN_WIDTH, height=SCREEN_HEIGHT, title=SCREEN_TITLE)
         arcade.set_background_color(arcade.color.AMAZON)
 
         self.client = client            # Client used to send events to the server and to receive game state updates.
-        self.GS = None                  # Current game state
+        self.GS = None                  # Current game state, including the predicted results of our own events
+        self.server_GS = None           # Last game state confirmed by the server
+        self.predictions = []           # (version, event, action_done before it) of the events not confirmed yet,
+                                        # the version is None while the event waits for the end of the turn
+        self.update_queue = UpdateQueue()   # Broadcasts received by the network thread, applied in on_update
+        self.profiler = profiler        # Optional FrameProfiler timing the frames and drawing its HUD
+        self.startup = None             # Optional StartupTimer of the client, told about the frames until the
+                                        # first game state is shown
 
         self.connection: bool = False   # Server connection
         self.player_name: str = ""      # Player's name
@@ -73,9 +109,14 @@ class GameWindow(arcade.Window):
 
         self.buttons = [self.info_btn, self.burn_btn, self.place_btn, self.pull_btn, self.next_btn]
 
+        # Geometry of the buttons and name tabs, only rebuilt when one of them is pressed or highlighted:
+        self.widget_batch = WidgetBatch(self.buttons)
+
         # Cards:
         self.cards_generated = False
         self.card_tab_list = CardTabList()          # Card Tab arcade.Spritelist
+        self.hand_tabs = {}                         # KEY: (player_id, card_index)   VALUE: CardTab
+        self.table_tabs = {}                        # KEY: color   VALUE: CardTab of the top card in the column
         self.selected_card_tab = None
 
         # Message Pop-up:
@@ -83,6 +124,15 @@ class GameWindow(arcade.Window):
         self.message_timer = None       # time of the message popup start
         self.message_duration = 2.0     # seconds for the message to disappear
 
+        # Text labels, rendered once and only rebuilt when their text changes:
+        self.connection_label = TextLabel('Waiting for server connection...', SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)
+        self.waiting_label = TextLabel('', SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)
+        self.info_label = TextLabel('', SCREEN_WIDTH - 100, SCREEN_HEIGHT / 2 - 50)
+        self.life_label = TextLabel('', SCREEN_WIDTH - 70, SCREEN_HEIGHT / 2 - 100)
+        self.started_label = TextLabel('The game has started', SCREEN_WIDTH / 4, SCREEN_HEIGHT / 4,
+                                       font_size=12, anchor_x='left', anchor_y='bottom')
+        self.message_label = TextLabel('', SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, color=arcade.color.YELLOW, font_size=15)
+
         # Some game state logic on the client side:
         self.action_done = False
 
@@ -100,17 +150,14 @@ class GameWindow(arcade.Window):
 
     def draw_start_screen(self):
         if not self.connection:
-            arcade.draw_text(f'Waiting for server connection...',
-                             SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, arcade.color.WHITE, 14,
-                             align="center", anchor_x='center', anchor_y='center')
+            self.connection_label.draw()
 
         if self.GS is not None:
             if len(self.GS.players.keys()) < MAX_PLAYERS:
-                arcade.draw_text(f'Waiting for players...{len(self.GS.players)}/{MAX_PLAYERS}',
-                                 SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, arcade.color.WHITE, 14,
-                                 align="center", anchor_x='center', anchor_y='center')
+                self.waiting_label.draw()
 
     def on_draw(self):
+        start = time.perf_counter()
         arcade.start_render()
 
         # Draw purple background:
@@ -122,22 +169,12 @@ class GameWindow(arcade.Window):
 
         # If the game has started, draw the UI elements:
         else:
-            # 2) Player Names
-            for _, n in self.name_tabs.items():
-                n.draw()
-
-            # 3) Buttons
-            for b in self.buttons:
-                b.draw()
+            # 2) Player Names and 3) Buttons
+            self.widget_batch.draw()
 
             # 4) Texts
-            arcade.draw_text(f'INFO POINTS: {self.GS.info_points}',
-                             SCREEN_WIDTH - 100, SCREEN_HEIGHT / 2 - 50, arcade.color.WHITE, 14,
-                             align="center", anchor_x='center', anchor_y='center')
-
-            arcade.draw_text(f'LIFE POINTS: {self.GS.life_points}',
-                             SCREEN_WIDTH - 70, SCREEN_HEIGHT / 2 - 100, arcade.color.WHITE, 14,
-                             align="center", anchor_x='center', anchor_y='center')
+            self.info_label.draw()
+            self.life_label.draw()
 
             # 5) Draw Cards
             self.card_tab_list.draw()
@@ -150,31 +187,187 @@ class GameWindow(arcade.Window):
             # 7) Display message:
             self.draw_message()
 
-            try:
-                if self.GS.started:
-                    arcade.draw_text('The game has started', SCREEN_WIDTH/4, SCREEN_HEIGHT/4, arcade.color.WHITE)
-                else:
-                    arcade.draw_text('GS.started is false', SCREEN_WIDTH / 4, SCREEN_HEIGHT / 4, arcade.color.WHITE)
-            except:
-                pass
+            self.started_label.draw()
+
+        if self.profiler is not None:
+            self.profiler.frame_drawn(start)
+            self.profiler.draw()
+
+        if self.startup is not None:
+            self.startup.frame_drawn(self)
+
+    def on_key_press(self, key, modifiers):
+        if self.profiler is not None:
+            self.profiler.on_key_press(key, modifiers)
+
+    def reset_game(self):
+
+        """ Forgets the current game, the next game state update starts a new one. """
+
+        self.GS = None
+        self.server_GS = None
+        self.predictions = []
+        self.action_done = False
+
+        self.cards_generated = False
+        self.card_tab_list = CardTabList()
+        self.hand_tabs = {}
+        self.table_tabs = {}
+        self.discard_pile_card_tabs_top = None
+        self.selected_card_tab = None
+
+    def on_update(self, delta_time: float):
+        start = time.perf_counter()
+        received = self.apply_queued_updates()
+
+        if self.profiler is not None:
+            self.profiler.updates_applied(start, received)
+
+    def apply_queued_updates(self):
+
+        """ Applies the game state broadcasts that arrived since the last tick, on the GUI thread.
+        Returns the times they were received. """
+
+        pending = self.update_queue.drain()
+
+        for data, _ in pending:
+            if type(data) is GameStateUpdate:
+                self.update_server_state(data)
+
+            elif type(data) is EventRejected:
+                self.reject_predictions(data)
+
+            # A delta that does not follow the current version means we missed one, ask for the full state:
+            elif not self.apply_game_state_delta(data):
+                self.client.request_resync(self.server_GS.version if self.server_GS is not None else -1)
+
+        return [received for _, received in pending]
+
+    def send_game_event(self, event):
+
+        """ Shows the result of a player event right away. The events are collected until the player ends the
+        turn, then the server gets all of them in one Turn packet.
+            Returns False if the event is not possible in the current game state. """
+
+        if not self.predict(event):
+            self.show_message('This move is not possible now.')
+            return False
+
+        if type(event) is NextTurn:
+            self.send_turn()
+        return True
+
+    def predict(self, event):
+
+        """ Applies the player's own event to a copy of the current game state with the rules of the server.
+        The prediction is kept until the server confirms it with the version it predicted, or rejects it. """
+
+        if self.GS is None or self.server_GS is None:
+            return False
+
+        mirror = MirrorGameState(self.GS, self.action_done)
+        if not mirror.update(event):
+            return False
+
+        self.predictions.append((None, event, self.action_done))
+        self.update_game_state(mirror.to_packet(self.GS.players))
+        return True
+
+    def send_turn(self):
+
+        """ Sends the predicted events that were not sent yet as one Turn, the server applies it as one update. """
+
+        sent = [prediction for prediction in self.predictions if prediction[0] is not None]
+        unsent = [prediction for prediction in self.predictions if prediction[0] is None]
+        if not unsent:
+            return
+
+        version = (sent[-1][0] if sent else self.server_GS.version) + 1
+        _, _, action_done = unsent[0]
+        turn = Turn(self.player_id, [event for _, event, _ in unsent])
 
-    def generate_card_tabs(self, player_hands):
+        self.predictions = sent + [(version, turn, action_done)]
+        self.client.send_game_event(turn)
+
+    def predicted_state(self):
+
+        """ The last server state with the events that are not confirmed yet applied on top of it. """
+
+        if not self.predictions:
+            return self.server_GS
+
+        _, _, action_done = self.predictions[0]
+        mirror = MirrorGameState(self.server_GS, action_done)
+
+        for _, event, _ in self.predictions:
+            if not mirror.update(event):
+                # The server state has moved on in a way our events do not fit anymore:
+                self.predictions = []
+                return self.server_GS
+
+        return mirror.to_packet(self.server_GS.players)
+
+    def update_server_state(self, game_state_update: GameStateUpdate):
+
+        """ Reconciles with a new state from the server: the predictions up to its version are confirmed,
+        the rest is applied again on top of it. """
+
+        self.server_GS = game_state_update
+
+        while self.predictions and self.predictions[0][0] is not None \
+                and self.predictions[0][0] <= game_state_update.version:
+            self.predictions.pop(0)
+
+        self.update_game_state(self.predicted_state())
+
+    def reject_predictions(self, rejection: EventRejected):
+
+        """ The server did not accept one of our events: roll back to the server state. The events sent after
+        the rejected one were predicted on top of it, so they are dropped as well. """
+
+        if self.predictions:
+            _, _, self.action_done = self.predictions[0]
+            self.predictions = []
+
+            if self.server_GS is not None:
+                self.update_game_state(self.server_GS)
+
+        self.show_message('The server rejected your move.')
+
+    def generate_card_tabs(self, game_state: GameStateUpdate):
+
+        """ Makes one CardTab for every hand slot, table stash column and for the discard pile. Afterwards the
+        tabs are only updated by game_state_cards_diff. """
 
         # Loop through the players and generate the cards tabs GUI elements:
-        for player_id in player_hands:
+        for player_id, hand in game_state.player_hands.items():
 
             # If the card is in the client's hand: hide the sprite (self_card).
             self_card = self.player_id == player_id
             loc = self.player_locations[player_id]
 
             # Loop through the 4 cards and generate each Sprite and add to the SpriteList:
-            for card_index, card in player_hands[player_id].items():
+            for card_index, card in hand.items():
                 card_tab = CardTab(card=card, loc=loc, index=card_index, self_card=self_card)
                 self.card_tab_list.append(card_tab)
+                self.hand_tabs[player_id, card_index] = card_tab
+
+        # The table stash shows the top card of each color:
+        for color in COLORS:
+            column = game_state.table_stash.get(color)
+            card_tab = CardTab(card=column[-1] if column else EMPTY, loc='table', index=COLORS.index(color))
+            self.card_tab_list.append(card_tab)
+            self.table_tabs[color] = card_tab
+
+        # The discard pile shows its top card:
+        discard_pile = game_state.discard_pile
+        self.discard_pile_card_tabs_top = CardTab(card=discard_pile[-1] if discard_pile else EMPTY,
+                                                  loc='discard', index=0)
+        self.card_tab_list.append(self.discard_pile_card_tabs_top)
 
     def has_four_cards(self):
         for idx, card in self.GS.player_hands[self.player_id].items():
-            if card["color"] == "empty":
+            if card is EMPTY:
                 return False
         return True
 
@@ -201,20 +394,55 @@ class GameWindow(arcade.Window):
             self.name_tabs[player_id] = nametab
 
         self.player_locations = player_locations
+        self.widget_batch.set_widgets([*self.name_tabs.values(), *self.buttons])
 
     def game_state_cards_diff(self, new):
-        """ This method compares the old and the new game state to update the cards."""
-        pass
+
+        """ This method compares the old and the new game state to update the cards. Only the tabs of the
+        changed slots get a new card, the sprites themselves are kept. """
+
+        old = self.GS
+
+        # 1) Hands. A delta only copies the hands it changes, the others are the same dict objects:
+        for player_id, hand in new.player_hands.items():
+            old_hand = old.player_hands.get(player_id)
+            if hand is old_hand:
+                continue
+
+            for card_index, card in hand.items():
+                if old_hand is None or old_hand.get(card_index) is not card:
+                    self.hand_tabs[player_id, card_index].set_card(card)
+
+        # 2) Table stash, the columns only grow:
+        for color, column in new.table_stash.items():
+            old_column = old.table_stash.get(color)
+            if column is not old_column:
+                self.table_tabs[color].set_card(column[-1] if column else EMPTY)
+
+        # 3) Discard pile, it only grows:
+        if len(new.discard_pile) != len(old.discard_pile):
+            self.discard_pile_card_tabs_top.set_card(new.discard_pile[-1] if new.discard_pile else EMPTY)
+
+        # A selected card that left the hand can not be used anymore:
+        if self.selected_card_tab is not None and self.selected_card_tab.card is EMPTY:
+            self.selected_card_tab = None
+
+    def update_text_labels(self, game_state_update: GameStateUpdate):
+        self.waiting_label.set_text(f'Waiting for players...{len(game_state_update.players)}/{MAX_PLAYERS}')
+        self.info_label.set_text(f'INFO POINTS: {game_state_update.info_points}')
+        self.life_label.set_text(f'LIFE POINTS: {game_state_update.life_points}')
 
     def update_game_state(self, game_state_update: GameStateUpdate):
 
+        self.update_text_labels(game_state_update)
+
+        # The first game state, it can already be a running game (e.g. after rejoining or in a replay):
         if self.GS is None:
             self.GS = game_state_update
             self.update_name_tabs(game_state_update.players)
-            return
 
         # If the players numbers have changed:
-        if len(self.GS.players) != len(game_state_update.players):
+        elif len(self.GS.players) != len(game_state_update.players):
             self.update_name_tabs(game_state_update.players)
 
         # If the game hasn't started yet, finish the update and return.
@@ -223,10 +451,12 @@ class GameWindow(arcade.Window):
             self.GS = game_state_update
             return
 
-        # 0) Make the card tabs at the start of the game.
+        # 0) Make the card tabs at the start of the game, afterwards update the ones that changed:
         if not self.cards_generated:
-            self.generate_card_tabs(game_state_update.player_hands)
+            self.generate_card_tabs(game_state_update)
             self.cards_generated = True
+        else:
+            self.game_state_cards_diff(game_state_update)
 
         # 1) Highlight the player name tab whose turn it is:
         for player_id, nametab in self.name_tabs.items():
@@ -235,16 +465,30 @@ class GameWindow(arcade.Window):
             else:
                 nametab.set_highlight(False)
 
-        # 2) Create a diff between current game state and new game state
-
-        # 3) Update the card tabs according to the diff
-
-        # 4)
+        # 2)
         self.discard_pile_size = len(game_state_update.discard_pile)
 
         # Update the current GS object.
         self.GS = game_state_update
 
+    def apply_game_state_delta(self, delta: GameStateDelta):
+
+        """ Applies a delta broadcast on top of the current game state.
+            Returns False if the delta does not follow the current version and a full update is needed. """
+
+        if self.server_GS is None:
+            return False
+
+        # Already included in the current game state (e.g. it arrived right after a full update):
+        if delta.version <= self.server_GS.version:
+            return True
+
+        if delta.version != self.server_GS.version + 1:
+            return False
+
+        self.update_server_state(self.server_GS.apply_delta(delta))
+        return True
+
     def get_card_selection(self):
 
         """ Return the card dict and the index of the card that is being selected.
@@ -348,9 +592,8 @@ class GameWindow(arcade.Window):
         """ Player event: When the INFO button is clicked."""
 
         event = InfoUsed(self.player_id)
-        self.client.send_game_event(event.to_bytes())
-
-        self.action_done = True
+        if self.send_game_event(event):
+            self.action_done = True
 
     @_player_event
     @_player_action
@@ -360,9 +603,8 @@ class GameWindow(arcade.Window):
         """ Player event: When the BURN button is clicked."""
 
         event = CardBurned(self.player_id, card, card_position)
-        self.client.send_game_event(event.to_bytes())
-
-        self.action_done = True
+        if self.send_game_event(event):
+            self.action_done = True
 
     @_player_event
     @_player_action
@@ -372,9 +614,8 @@ class GameWindow(arcade.Window):
         """ Player event: When the PLACE button is clicked."""
 
         event = CardPlaced(self.player_id, card, card_position)
-        self.client.send_game_event(event.to_bytes())
-
-        self.action_done = True
+        if self.send_game_event(event):
+            self.action_done = True
 
     @_player_event
     def pull_btn_click(self):
@@ -385,7 +626,7 @@ class GameWindow(arcade.Window):
             return
 
         event = CardPull(self.player_id)
-        self.client.send_game_event(event.to_bytes())
+        self.send_game_event(event)
 
     @_player_event
     def next_btn_click(self):
@@ -397,22 +638,18 @@ class GameWindow(arcade.Window):
             return
 
         event = NextTurn(self.player_id)
-        self.client.send_game_event(event.to_bytes())
-
-        self.action_done = False
+        if self.send_game_event(event):
+            self.action_done = False
 
     def show_message(self, text):
         self.message_text = text
         self.message_timer = time.time()
+        self.message_label.set_text(text)
 
     def draw_message(self):
         if self.message_text is not None:
             if time.time() - self.message_timer < self.message_duration:
-                arcade.draw_text(self.message_text,
-                                 SCREEN_WIDTH / 2,
-                                 SCREEN_HEIGHT / 2,
-                                 arcade.color.YELLOW, 15,
-                                 align="center", anchor_x='center', anchor_y='center')
+                self.message_label.draw()
             else:
                 self.message_text = None
                 self.message_timer = None
@@ -1,41 +1,197 @@
 import arcade
 import os
 import typing
+from threading import Thread, Lock
+from PIL import Image, ImageDraw, ImageFont
+from cards import COLORS, NUMBERS, EMPTY, UNKNOWN
 from settings import *
 
 
 PARENT_DIR = os.path.abspath(os.path.dirname(__file__))
+ASSETS_PATH = os.path.join(PARENT_DIR, 'assets')
+
+CARD_SCALE = 0.65                           # Scaling of the card images
+QUESTION_MARK = 'question_mark.png'         # Image of the hidden cards
+
+# Fonts tried in order for the text labels, the PIL default font is the last resort:
+FONT_NAMES = ('arial.ttf', 'Arial.ttf', 'DejaVuSans.ttf')
+FONT_SIZES = (9, 12, 14, 15, 18, 20)        # Sizes of the labels, buttons, name tabs and the profiler HUD
 
 
 def hex_to_rgb(h):
     return tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
 
 
+# Loaded fonts by size and the rendered text textures by text and style, shared by all TextLabels:
+_fonts = {}
+_text_textures = {}
+MAX_TEXT_TEXTURES = 256
+
+
+def load_font(font_size):
+    font = _fonts.get(font_size)
+    if font is None:
+        for font_name in FONT_NAMES:
+            try:
+                font = ImageFont.truetype(font_name, font_size)
+                break
+            except OSError:
+                continue
+        else:
+            font = ImageFont.load_default()
+        _fonts[font_size] = font
+    return font
+
+
+def preload_fonts(sizes=FONT_SIZES):
+
+    """ Looks up the font in every size the GUI uses. Finding the font file is the slow part of the first
+    TextLabel, so the client does this on its preload thread while the window is being created. """
+
+    for font_size in sizes:
+        load_font(font_size)
+
+
+def get_text_texture(text, color, font_size):
+
+    """ Returns a texture with the text rendered on a transparent background. Each text and style is only
+    rendered once. """
+
+    key = (text, tuple(color), font_size)
+    texture = _text_textures.get(key)
+
+    if texture is None:
+        font = load_font(font_size)
+        left, top, right, bottom = font.getbbox(text)
+
+        image = Image.new('RGBA', (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+        ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=tuple(color))
+
+        # Old texts are not worth keeping around forever (e.g. many different messages):
+        if len(_text_textures) >= MAX_TEXT_TEXTURES:
+            _text_textures.clear()
+
+        texture = arcade.Texture(f'text-{key}', image)
+        _text_textures[key] = texture
+
+    return texture
+
+
+class TextLabel:
+
+    """ A line of text, rendered into a texture once and drawn as a textured rectangle every frame.
+    The texture is only rebuilt when the text is changed with set_text. """
+
+    def __init__(self, text, x, y, color=arcade.color.WHITE, font_size=14, anchor_x='center', anchor_y='center'):
+        self.x = x
+        self.y = y
+        self.color = color
+        self.font_size = font_size
+        self.anchor_x = anchor_x
+        self.anchor_y = anchor_y
+
+        self.text = None
+        self.texture = None
+        self.set_text(text)
+
+    def set_text(self, text):
+        if text == self.text:
+            return
+
+        self.text = text
+        self.texture = get_text_texture(text, self.color, self.font_size) if text else None
+
+    def draw(self, x=None, y=None):
+
+        """ Draws the label at its own location, or at (x, y) if given. """
+
+        if self.texture is None:
+            return
+
+        x = self.x if x is None else x
+        y = self.y if y is None else y
+        width = self.texture.width
+        height = self.texture.height
+
+        if self.anchor_x == 'left':
+            x += width / 2
+        elif self.anchor_x == 'right':
+            x -= width / 2
+
+        if self.anchor_y == 'bottom':
+            y += height / 2
+        elif self.anchor_y == 'top':
+            y -= height / 2
+
+        arcade.draw_texture_rectangle(x, y, width, height, self.texture)
+
+
+class TextureRegistry:
+
+    """ The card textures of the process. Every image in assets is loaded and scaled only once, the CardTabs get
+    their textures from here without touching the disk. preload() loads all of them up front, optionally on a
+    background thread while the rest of the client starts. """
+
+    def __init__(self, scale=CARD_SCALE):
+        self.scale = scale
+        self.textures = {}
+        self.lock = Lock()          # The preload thread and the GUI thread may ask for the same texture
+
+    @staticmethod
+    def filenames():
+        colors = [*COLORS, 'rainbow']
+        return [f'{col}_{num}.png' for col in colors for num in NUMBERS] + [QUESTION_MARK]
+
+    def load(self, filename):
+        with self.lock:
+            texture = self.textures.get(filename)
+            if texture is None:
+                texture = arcade.draw_commands.load_texture(os.path.join(ASSETS_PATH, filename), scale=self.scale)
+                self.textures[filename] = texture
+        return texture
+
+    def preload(self, background=False):
+        if background:
+            thread = Thread(target=self.preload, daemon=True)
+            thread.start()
+            return thread
+
+        for filename in self.filenames():
+            self.load(filename)
+
+    def card_texture(self, card):
+        # EMPTY slots have no image of their own, their tabs are hidden. UNKNOWN cards are not known yet:
+        if card is EMPTY or card is UNKNOWN:
+            return self.question_mark_texture()
+        return self.load(f'{card.color}_{card.number}.png')
+
+    def question_mark_texture(self):
+        return self.load(QUESTION_MARK)
+
+
+# Shared by all the CardTabs:
+card_textures = TextureRegistry()
+
+
 class CardTab(arcade.Sprite):
     def __init__(self, card, loc, index, self_card=False):
 
-        self.card = card                            # dict object with color and number
+        self.card = card                            # Card object with color and number
         self.location = CARD_LOCATIONS[loc][index]  # Global settings for the locations
         self.index = index                          # Store index
         self.x = self.location[0]                   # Card Tab location x
         self.y = self.location[1]                   # Card Tab location y
         self.self_card = self_card                  # Boolean to show whether the card is in the player's hands:
-        self.original_scale = 0.65                  # Scaling the image.
+        self.original_scale = CARD_SCALE            # Scaling the image.
         self.selection_scale = 0.75                 # Scaling it up when selected
 
-        # Get filepaths for the assets
-        assets_path = os.path.join(PARENT_DIR, 'assets')
-        self.col = card["color"]
-        self.num = card["number"]
-        filename = f'{self.col}_{self.num}.png'
-        filename_question_mark = "question_mark.png"
-        filepath = os.path.join(assets_path, filename)
-
-        # Load sprite with additional question mark texture
-        super().__init__(filename=filepath, scale=self.original_scale, center_x=self.x, center_y=self.y)
-        question_mark_texture = arcade.draw_commands.load_texture(os.path.join(assets_path, filename_question_mark),
-                                                                  scale=self.original_scale)
-        self.append_texture(question_mark_texture)
+        self.col = card.color
+        self.num = card.number
+
+        # Sprite with the card texture and the question mark texture, both from the shared registry
+        super().__init__(scale=self.original_scale, center_x=self.x, center_y=self.y)
+        self.append_texture(card_textures.card_texture(card))
+        self.append_texture(card_textures.question_mark_texture())
         self._set_scale(self.original_scale)
 
         # If the card is the player's card: show question mark texture
@@ -47,7 +203,36 @@ class CardTab(arcade.Sprite):
         self.selected = False
         self.currently_pressed = False
 
+        # Empty slots stay in the sprite list, but are not drawn:
+        if card is EMPTY:
+            self.alpha = 0
+
+    def set_card(self, card):
+
+        """ Shows another card in this slot, reusing the sprite and the loaded textures. EMPTY hides the tab. """
+
+        if card is self.card:
+            return
+
+        self.card = card
+        self.col = card.color
+        self.num = card.number
+        self.textures[0] = card_textures.card_texture(card)
+
+        if card is EMPTY:
+            self.currently_pressed = False
+            self.selected = False
+            self.alpha = 0
+        else:
+            self.alpha = 255
+
+        # Refresh the shown texture, the player's own cards keep the question mark:
+        self.set_texture(1 if self.self_card else 0)
+        self._set_scale(self.selection_scale if self.selected else self.original_scale)
+
     def check_mouse_press(self, x, y):
+        if self.card is EMPTY:
+            return False
         if x > self.center_x + self.width / 2:
             return False
         if x < self.center_x - self.width / 2:
@@ -97,6 +282,42 @@ class CardTabList(arcade.SpriteList):
         return iter(self.sprite_list)
 
 
+class WidgetBatch:
+
+    """ Retained geometry of the static widgets (buttons, name tabs). Their rectangles and lines are built once
+    into one ShapeElementList, like the gradient background of the GameWindow, and drawn with a single call.
+    The widgets call invalidate() when they get pressed or highlighted, and only then is the batch rebuilt.
+    The text labels are textures and are drawn on top. """
+
+    def __init__(self, widgets=()):
+        self.widgets = []
+        self.shapes = None
+        self.set_widgets(widgets)
+
+    def set_widgets(self, widgets):
+        self.widgets = list(widgets)
+        for widget in self.widgets:
+            widget.batch = self
+        self.invalidate()
+
+    def invalidate(self):
+        self.shapes = None
+
+    def build(self):
+        self.shapes = arcade.ShapeElementList()
+        for widget in self.widgets:
+            for shape in widget.create_shapes():
+                self.shapes.append(shape)
+
+    def draw(self):
+        if self.shapes is None:
+            self.build()
+        self.shapes.draw()
+
+        for widget in self.widgets:
+            widget.draw_text()
+
+
 class NameTab:
     def __init__(self, center_x, center_y, width=NAME_WIDTH, height=NAME_HEIGHT, text='DefaultText'):
         self.font = 20
@@ -112,23 +333,28 @@ class NameTab:
         self.color: arcade.Color = hex_to_rgb('13547a')
 
         self.highlight = False
+        self.label = TextLabel(text, center_x, center_y, color=arcade.color.BLACK, font_size=self.font)
+        self.batch = None               # WidgetBatch holding the geometry, if any
 
-    def draw(self):
-        if self.highlight:
-            arcade.draw_rectangle_filled(center_x=self.center_x, center_y=self.center_y,
-                                         width=self.width, height=self.height,
-                                         color=self.highlight_color)
-        else:
-            arcade.draw_rectangle_filled(center_x=self.center_x, center_y=self.center_y,
-                                         width=self.width, height=self.height,
-                                         color=self.color)
+    def create_shapes(self):
+        color = self.highlight_color if self.highlight else self.color
+        return [arcade.create_rectangle_filled(self.center_x, self.center_y, self.width, self.height, color)]
+
+    def draw_text(self):
+        self.label.draw()
 
-        arcade.draw_text(self.text, self.center_x, self.center_y,
-                         color=arcade.color.BLACK, font_size=self.font,
-                         width=self.width, align="center", anchor_x="center", anchor_y="center")
+    def draw(self):
+        for shape in self.create_shapes():
+            shape.draw()
+        self.draw_text()
 
     def set_highlight(self, foo: bool):
+        if foo == self.highlight:
+            return
+
         self.highlight = foo
+        if self.batch is not None:
+            self.batch.invalidate()
 
 
 class TextButton:
@@ -157,60 +383,58 @@ class TextButton:
         self.button_height = button_height
 
         self.action_function = action_function
+        self.label = TextLabel(text, center_x, center_y, color=arcade.color.BLACK, font_size=font_size)
+        self.batch = None               # WidgetBatch holding the geometry, if any
 
     def set_face_color(self, color: arcade.Color):
         self.face_color = color
+        self.invalidate()
         return 1
 
-    def draw(self):
-        arcade.draw_rectangle_filled(self.center_x, self.center_y, self.width, self.height, self.face_color)
-
-        if not self.pressed:
-            color = self.shadow_color
-        else:
-            color = self.highlight_color
-
-        # Bottom horizontal
-        arcade.draw_line(self.center_x - self.width / 2, self.center_y - self.height / 2,
-                         self.center_x + self.width / 2, self.center_y - self.height / 2,
-                         color, self.button_height)
+    def invalidate(self):
+        if self.batch is not None:
+            self.batch.invalidate()
 
-        # Right vertical
-        arcade.draw_line(self.center_x + self.width / 2, self.center_y - self.height / 2,
-                         self.center_x + self.width / 2, self.center_y + self.height / 2,
-                         color, self.button_height)
+    def create_shapes(self):
+        left = self.center_x - self.width / 2
+        right = self.center_x + self.width / 2
+        top = self.center_y + self.height / 2
+        bottom = self.center_y - self.height / 2
 
+        # The bottom and right edges are in shadow, unless the button is pressed:
         if not self.pressed:
-            color = self.highlight_color
+            lower_color, upper_color = self.shadow_color, self.highlight_color
         else:
-            color = self.shadow_color
-
-        # Top horizontal
-        arcade.draw_line(self.center_x - self.width / 2, self.center_y + self.height / 2,
-                         self.center_x + self.width / 2, self.center_y + self.height / 2,
-                         color, self.button_height)
+            lower_color, upper_color = self.highlight_color, self.shadow_color
 
-        # Left vertical
-        arcade.draw_line(self.center_x - self.width / 2, self.center_y - self.height / 2,
-                         self.center_x - self.width / 2, self.center_y + self.height / 2,
-                         color, self.button_height)
+        return [arcade.create_rectangle_filled(self.center_x, self.center_y, self.width, self.height,
+                                               self.face_color),
+                arcade.create_line(left, bottom, right, bottom, lower_color, self.button_height),    # Bottom
+                arcade.create_line(right, bottom, right, top, lower_color, self.button_height),      # Right
+                arcade.create_line(left, top, right, top, upper_color, self.button_height),          # Top
+                arcade.create_line(left, bottom, left, top, upper_color, self.button_height)]        # Left
 
+    def draw_text(self):
         text_x = self.center_x
         text_y = self.center_y
         if not self.pressed:
             text_x -= self.button_height
             text_y += self.button_height
 
-        arcade.draw_text(self.text, text_x, text_y,
-                         arcade.color.BLACK, font_size=self.font_size,
-                         width=self.width, align="center",
-                         anchor_x="center", anchor_y="center")
+        self.label.draw(text_x, text_y)
+
+    def draw(self):
+        for shape in self.create_shapes():
+            shape.draw()
+        self.draw_text()
 
     def on_press(self):
         self.pressed = True
+        self.invalidate()
 
     def on_release(self):
         self.pressed = False
+        self.invalidate()
         self.action_function()
 
     def check_mouse_press(self, x, y):
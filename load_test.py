@@ -0,0 +1,422 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+import packets
+from cards import EMPTY
+from game_logic import MirrorGameState
+from packets import InfoUsed, CardBurned, CardPlaced, CardPull, NextTurn, Turn
+from settings import HOST, MAX_PLAYERS
+
+''' Load test of the server with headless bot clients. The bots speak the same protocol as the game client:
+the ConnectionAttempt/ConnectionConfirmed handshake, then one Turn per move, and they follow the broadcasts
+through the deltas. They run as coroutines on one asyncio loop, so hundreds of them fit in this process.
+
+    python load_test.py --bots 200 --duration 30                Spawns a local threaded server and loads it
+    python load_test.py --bots 200 --asyncio                    The same with the asyncio server
+    python load_test.py --bots 200 --workers 4                  The same with the sharded server
+    python load_test.py --bots 200 --port 10000 --stats-port 10001
+                                                                Loads a server that is already running
+
+The bots fill the rooms MAX_PLAYERS at a time. When a game is over they leave together and start the next
+one in a new room, until the duration is up. The report has the accepted events per second (every event of
+a Turn counts), the latency from a bot sending its Turn to each bot of the room receiving the broadcast,
+and the CPU and memory use of the server, read from its stats endpoint.'''
+
+CONNECT_CONCURRENCY = 50        # Bots connecting at the same time
+SAMPLE_INTERVAL = 1.0           # Seconds between two reads of the server stats
+READ_SIZE = 65536
+
+
+class LoadStats:
+
+    """ What the bots measured, over all the rooms. """
+
+    def __init__(self):
+        self.latency = []                   # Seconds from a Turn sent to its broadcast received, per receiving bot
+        self.turns = 0
+        self.events = 0
+        self.rejected = 0
+        self.resyncs = 0
+        self.games = 0
+        self.denied = 0
+        self.errors = 0                     # Connections that failed or broke
+        self.server_samples = []            # (time, process stats of the server) during the run
+
+
+def latency_summary(samples):
+
+    """ Exact percentiles of the latencies in milliseconds. """
+
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    summary = {'count': len(ordered), 'mean_ms': 1000 * sum(ordered) / len(ordered)}
+    for p in (50, 90, 99):
+        summary[f'p{p}_ms'] = 1000 * ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    summary['max_ms'] = 1000 * ordered[-1]
+    return summary
+
+
+class BotTable:
+
+    """ The bots playing in the same room. They move on to the next room together when a game is over. """
+
+    def __init__(self, name):
+        self.name = name
+        self.game = 0
+        self.bots = []
+        self.sent_at = {}                   # KEY: version the Turn will produce   VALUE: time it was sent
+
+    def end_game(self):
+        # Closing the connections wakes up the bots still waiting for a broadcast:
+        for bot in self.bots:
+            bot.done = True
+            if bot.writer is not None:
+                bot.writer.close()
+
+    @property
+    def room(self):
+        return f'{self.name}-{self.game}'
+
+
+def choose_turn(player_id, state):
+
+    """ A simple policy: place a card that fits on the table, otherwise give info if there are points left,
+    otherwise burn a card. The bots read their own hand from the broadcast, which a human player could not,
+    but it keeps the games long enough to measure. """
+
+    hand = state.player_hands[player_id]
+    table = {col: len(column) for col, column in state.table_stash.items()}
+
+    fitting = [position for position, card in hand.items()
+               if card is not EMPTY and card.number == table.get(card.color, 0) + 1]
+
+    if fitting:
+        events = [CardPlaced(player_id, hand[fitting[0]], fitting[0]), CardPull(player_id)]
+    elif state.info_points > 0 and random.random() < 0.5:
+        events = [InfoUsed(player_id)]
+    else:
+        position = random.choice([position for position, card in hand.items() if card is not EMPTY])
+        events = [CardBurned(player_id, hand[position], position), CardPull(player_id)]
+
+    return Turn(player_id, events + [NextTurn(player_id)])
+
+
+def game_over(state):
+
+    """ No more turns can be played: the game is lost, or a card taken from a hand cannot be replaced. """
+
+    return state.life_points == 0 or len(MirrorGameState(state).deck) == 0
+
+
+class Bot:
+
+    """ One headless client. """
+
+    def __init__(self, name, table, stats, address, codecs, connect_limit, think=0.0):
+        self.name = name
+        self.table = table
+        self.connect_limit = connect_limit  # Semaphore around the connects, not to overflow the server backlog
+        self.stats = stats
+        self.address = address
+        self.codecs = codecs
+        self.think = think                  # Seconds to wait before each move
+
+        self.writer = None
+        self.player_id = None
+        self.codec = 'json'
+        self.state = None                   # The GameStateUpdate with the deltas applied
+        self.last_turn = None
+        self.sent_version = None            # Version the last Turn was sent at, until it is answered
+        self.resync_requested = False
+        self.done = False                   # The game of this room is over
+
+    async def play_game(self, deadline):
+
+        """ Joins the room of the table and plays until the game is over or the deadline has passed. """
+
+        self.state = None
+        self.sent_version = None
+        self.done = False
+
+        async with self.connect_limit:
+            reader, self.writer = await asyncio.open_connection(*self.address)
+        decoder = packets.PacketDecoder()
+
+        try:
+            attempt = packets.ConnectionAttempt(self.name, self.codecs, self.table.room)
+            self.writer.write(attempt.to_bytes())
+
+            while not self.done and time.monotonic() < deadline:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    break
+
+                decoder.feed(data)
+                for packet in decoder:
+                    await self.handle_packet(packet)
+
+        finally:
+            self.table.end_game()
+
+    async def handle_packet(self, packet):
+        now = time.perf_counter()
+
+        if type(packet) is packets.ConnectionConfirmed:
+            if not packet.confirmed:
+                self.stats.denied += 1
+                self.done = True
+            self.player_id = packet.player_id
+            self.codec = packet.codec
+            return
+
+        if type(packet) is packets.GameStateUpdate:
+            packet.keys_to_ints()
+            self.state = packet
+            self.resync_requested = False
+
+        elif type(packet) is packets.GameStateDelta:
+            if self.resync_requested:
+                return
+            if self.state is None or packet.version != self.state.version + 1:
+                self.resync_requested = True
+                self.stats.resyncs += 1
+                version = self.state.version if self.state is not None else -1
+                self.writer.write(packets.ResyncRequest(version).to_bytes(self.codec))
+                return
+            self.state = self.state.apply_delta(packet)
+
+        elif type(packet) is packets.EventRejected:
+            # The policy only sends turns the rules allow, a rejection ends the game for this bot:
+            self.stats.rejected += 1
+            self.done = True
+            return
+
+        else:
+            return
+
+        sent = self.table.sent_at.get(self.state.version)
+        if sent is not None:
+            self.stats.latency.append(now - sent)
+
+        if not self.state.started:
+            return
+
+        if self.sent_version is not None and self.state.version > self.sent_version:
+            self.stats.turns += 1
+            self.stats.events += len(self.last_turn.events)
+            self.sent_version = None
+
+        if game_over(self.state):
+            self.done = True
+            return
+
+        if self.state.current_player == self.player_id and self.sent_version is None:
+            await self.move()
+
+    async def move(self):
+        if self.think:
+            await asyncio.sleep(self.think)
+
+        self.last_turn = choose_turn(self.player_id, self.state)
+        self.sent_version = self.state.version
+        self.table.sent_at[self.state.version + 1] = time.perf_counter()
+        self.writer.write(self.last_turn.to_bytes(self.codec))
+
+
+async def run_table(table, stats, deadline):
+
+    """ Plays games with the bots of one table until the deadline. """
+
+    while time.monotonic() < deadline:
+        results = await asyncio.gather(*(bot.play_game(deadline) for bot in table.bots), return_exceptions=True)
+        for result in results:
+            if isinstance(result, OSError):
+                stats.errors += 1
+
+        stats.games += 1
+        table.game += 1
+        table.sent_at = {}
+
+
+async def sample_server(host, stats_port, stats, deadline):
+
+    """ Reads the process stats of the server every SAMPLE_INTERVAL seconds until the deadline. """
+
+    loop = asyncio.get_running_loop()
+    while True:
+        snapshot = await loop.run_in_executor(None, fetch_stats, host, stats_port)
+        if snapshot is not None:
+            # A sharded server adds up the front and its workers:
+            stats.server_samples.append((time.perf_counter(), snapshot.get('total_process', snapshot['process'])))
+        if time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(min(SAMPLE_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+
+async def run_bots(address, stats_port, n_bots, players, duration, codecs, think):
+    stats = LoadStats()
+    deadline = time.monotonic() + duration
+    connect_limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    run_id = os.getpid()
+
+    tasks = []
+    for index in range(n_bots // players):
+        table = BotTable(f'load-{run_id}-{index}')
+        table.bots = [Bot(f'bot-{index}-{seat}', table, stats, address, codecs, connect_limit, think)
+                      for seat in range(players)]
+        tasks.append(run_table(table, stats, deadline))
+
+    if stats_port is not None:
+        tasks.append(sample_server(address[0], stats_port, stats, deadline))
+
+    await asyncio.gather(*tasks)
+    return stats
+
+
+# --- The server --- #
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(port, stats_port, use_asyncio=False, workers=None):
+
+    """ Starts a server process on localhost and waits until it accepts connections. With workers, the sharded
+    server is started. """
+
+    script = 'server_sharded.py' if workers else 'server_socketserver.py'
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script),
+               '--host', 'localhost', '--port', str(port), '--stats-port', str(stats_port), '--log-level', 'WARNING']
+    if workers:
+        command += ['--workers', str(workers)]
+    elif use_asyncio:
+        command.append('--asyncio')
+
+    process = subprocess.Popen(command)
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError('The server did not start.')
+
+
+def fetch_stats(host, stats_port):
+    try:
+        with urllib.request.urlopen(f'http://{host}:{stats_port}/', timeout=5) as response:
+            return json.load(response)
+    except OSError:
+        return None
+
+
+def report(stats, elapsed, harness_cpu, n_bots):
+
+    """ The results as a dict, see main() for the printout. """
+
+    result = {'bots': n_bots,
+              'seconds': elapsed,
+              'games': stats.games,
+              'turns': stats.turns,
+              'events': stats.events,
+              'events_per_s': stats.events / elapsed,
+              'turns_per_s': stats.turns / elapsed,
+              'rejected': stats.rejected,
+              'resyncs': stats.resyncs,
+              'denied': stats.denied,
+              'errors': stats.errors,
+              'broadcast_latency': latency_summary(stats.latency),
+              'harness_cpu_percent': 100 * harness_cpu / elapsed}
+
+    # The CPU use between the first and the last sample, the largest memory and thread count seen:
+    samples = stats.server_samples
+    if len(samples) >= 2:
+        (first_time, first), (last_time, last) = samples[0], samples[-1]
+        result['server'] = {'cpu_s': last['cpu_s'] - first['cpu_s'],
+                            'cpu_percent': 100 * (last['cpu_s'] - first['cpu_s']) / (last_time - first_time),
+                            'rss_kb': max(sample.get('rss_kb', 0) for _, sample in samples) or None,
+                            'max_rss_kb': last.get('max_rss_kb'),
+                            'threads': max(sample['threads'] for _, sample in samples)}
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyHanabi load test with bot clients')
+    parser.add_argument('--bots', type=int, default=100, help='number of bot clients')
+    parser.add_argument('--players', type=int, default=MAX_PLAYERS,
+                        help='players per room, has to match MAX_PLAYERS of the server')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds a bot waits before each move')
+    parser.add_argument('--codec', choices=packets.CODECS, help='codec the bots ask for, by default any')
+    parser.add_argument('--host', default=HOST, help='address of a running server')
+    parser.add_argument('--port', type=int, help='port of a running server, by default a local one is started')
+    parser.add_argument('--stats-port', type=int, help='stats port of the running server, for its CPU and memory')
+    parser.add_argument('--asyncio', action='store_true', help='start the asyncio server instead of the threaded one')
+    parser.add_argument('--workers', type=int, help='start the sharded server with this many worker processes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    process = None
+    host, port, stats_port = args.host, args.port, args.stats_port
+    if port is None:
+        host, port, stats_port = 'localhost', free_port(), free_port()
+        process = spawn_server(port, stats_port, args.asyncio, args.workers)
+
+    codecs = [args.codec] if args.codec else packets.CODECS
+
+    try:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        stats = asyncio.run(run_bots((host, port), stats_port, args.bots, args.players, args.duration, codecs,
+                                     args.think))
+        elapsed, harness_cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    result = report(stats, elapsed, harness_cpu, args.bots)
+    latency = result['broadcast_latency']
+
+    print(f'{args.bots} bots, {elapsed:.1f} s: {stats.games} games, {stats.turns} turns, {stats.events} events '
+          f'({result["events_per_s"]:.0f} events/s), {stats.rejected} rejected, {stats.resyncs} resyncs, '
+          f'{stats.denied} denied, {stats.errors} connection errors')
+    if latency['count']:
+        print(f'Broadcast latency: p50 {latency["p50_ms"]:.2f} ms, p90 {latency["p90_ms"]:.2f} ms, '
+              f'p99 {latency["p99_ms"]:.2f} ms, max {latency["max_ms"]:.2f} ms')
+    if 'server' in result:
+        server = result['server']
+        print(f'Server: {server["cpu_percent"]:.0f}% CPU, {server["rss_kb"]} kB resident at most, '
+              f'{server["threads"]} threads at most')
+    else:
+        print('Server CPU and memory unknown, give the --stats-port of the server.')
+
+    # One process of bots can use a single core. Near 100% the bots, not the server, limit the numbers:
+    print(f'Load test: {result["harness_cpu_percent"]:.0f}% CPU')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import time
+import logging
+from threading import Lock
+
+''' Logging setup of the server and the client. The modules log through logging.getLogger(__name__), the
+per-event messages of the game logic are on the DEBUG level. setup_logging() configures the level and adds
+the RateLimitFilter, so a flood of the same message (e.g. a misbehaving client) cannot slow down the server.'''
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+
+    """ Lets at most `burst` records of the same message through per `interval` seconds. Messages are told apart
+    by their logger and format string, so the arguments can vary. The number of dropped records is added to the
+    next one that gets through. """
+
+    def __init__(self, interval=1.0, burst=10):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.lock = Lock()
+        self.windows = {}           # KEY: (logger name, message)   VALUE: [window start, passed, suppressed]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+                return True
+
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+
+            window[2] += 1
+            return False
+
+
+def setup_logging(level='INFO', interval=1.0, burst=10):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(interval, burst))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
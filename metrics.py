@@ -0,0 +1,227 @@
+import json
+import time
+import logging
+import contextlib
+import threading
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+''' This module collects the counters and latency histograms of the server. Everything goes into the
+process-wide `metrics` object:
+
+    metrics.count('events_accepted')
+    with metrics.timer('game_state_update'):
+        ...
+
+The server can dump a snapshot of them to the log periodically (--stats-interval) and serve it as JSON on a
+local HTTP port (--stats-port):
+
+    curl http://localhost:10001/'''
+
+logger = logging.getLogger(__name__)
+
+N_BUCKETS = 32          # Latency buckets: [0, 1) us, [1, 2) us, [2, 4) us, ... up to about 35 minutes
+
+try:
+    import resource     # Not available on Windows
+except ImportError:
+    resource = None
+
+
+def process_stats():
+
+    """ CPU time and memory use of this process. The resident memory is read from /proc where there is one,
+    otherwise only its peak is known. """
+
+    stats = {'cpu_s': time.process_time(), 'threads': threading.active_count()}
+
+    try:
+        with open('/proc/self/statm') as f:
+            stats['rss_kb'] = int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, AttributeError):
+        pass
+
+    if resource is not None:
+        stats['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stats
+
+
+class Histogram:
+
+    """ Latencies counted in power of two buckets of microseconds. Recording one is a few integer operations,
+    the percentiles are estimated from the buckets (their upper bound). """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        us = seconds * 1e6
+        bucket = min(int(us).bit_length(), N_BUCKETS - 1)
+
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += us
+            if self.min is None or us < self.min:
+                self.min = us
+            if self.max is None or us > self.max:
+                self.max = us
+
+    def export(self):
+        with self.lock:
+            return {'buckets': list(self.buckets), 'count': self.count, 'total': self.total,
+                    'min': self.min, 'max': self.max}
+
+    def merge(self, exported):
+
+        """ Adds the latencies of an exported Histogram, e.g. of another process. """
+
+        with self.lock:
+            self.buckets = [a + b for a, b in zip(self.buckets, exported['buckets'])]
+            self.count += exported['count']
+            self.total += exported['total']
+            for name, pick in (('min', min), ('max', max)):
+                if exported[name] is not None:
+                    mine = getattr(self, name)
+                    setattr(self, name, exported[name] if mine is None else pick(mine, exported[name]))
+
+    def percentile(self, p):
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                # Upper bound of the bucket, but never more than the largest value seen:
+                return min(float(2 ** bucket), self.max)
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            if not self.count:
+                return {'count': 0}
+
+            return {'count': self.count,
+                    'mean_us': self.total / self.count,
+                    'min_us': self.min,
+                    'p50_us': self.percentile(50),
+                    'p90_us': self.percentile(90),
+                    'p99_us': self.percentile(99),
+                    'max_us': self.max}
+
+
+class Metrics:
+
+    """ Named counters and latency histograms, created on first use. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+
+        return {'uptime_s': time.time() - self.started,
+                'process': process_stats(),
+                'counters': counters,
+                'latency': {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}}
+
+    def export(self):
+
+        """ The counters and the whole histograms, to be merged into the metrics of another process. """
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+
+        return {'counters': counters,
+                'histograms': {name: histogram.export() for name, histogram in histograms.items()},
+                'process': process_stats()}
+
+    def merge(self, exported):
+        for name, n in exported['counters'].items():
+            self.count(name, n)
+        for name, histogram in exported['histograms'].items():
+            self.histogram(name).merge(histogram)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+
+# Shared by the whole process:
+metrics = Metrics()
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+
+    """ Answers every GET with the current metrics as JSON. """
+
+    def do_GET(self):
+        body = json.dumps(self.server.metrics.snapshot(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Stats request from %s: ' + format, self.client_address[0], *args)
+
+
+def serve_stats(port, host='localhost', source=metrics, handler_class=StatsRequestHandler):
+
+    """ Serves the metrics on a local HTTP port from a background thread. Returns the HTTP server. """
+
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    server.metrics = source
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving stats on http://%s:%d/', host, server.server_address[1])
+    return server
+
+
+def dump_periodically(interval, source=metrics):
+
+    """ Logs a snapshot of the metrics every interval seconds from a background thread. """
+
+    def dump_loop():
+        while True:
+            time.sleep(interval)
+            logger.info('Stats: %s', json.dumps(source.snapshot()))
+
+    thread = Thread(target=dump_loop, daemon=True)
+    thread.start()
+    return thread
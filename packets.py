@@ -1,11 +1,48 @@
 import sys
 import json
+import struct
 import pickle
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from cards import COLORS, CARDS, Card, card_from_dict
 
 ''' This module defines the data packets to be sent between the server and the clients.
 The base class DataPacket provides JSON serialization. The Dict2Obj can convert the sent
-dictionaries back to their original DataPacket objects.'''
+dictionaries back to their original DataPacket objects.
+
+Cards travel as {"color": ..., "number": ...} dictionaries on the wire. This module is the only place
+where they are converted to and from the interned Card objects of the cards module.
+
+On the TCP stream every packet is framed with a 4 byte length prefix, so that packets can be cut out of
+the stream no matter how recv() splits or merges them. The PacketDecoder does this incrementally.
+
+Besides JSON there is a compact binary codec. A binary payload starts with BINARY_MAGIC, the codec version
+and the packet type id, followed by the fields of the packet (see the write_binary/read_binary methods).
+JSON payloads always start with '{', so load() can tell the two apart. The client lists the codecs it can
+read in ConnectionAttempt and the server confirms the one it picked in ConnectionConfirmed. The handshake
+itself is always JSON.
+
+The server sends a full GameStateUpdate snapshot when a client joins and a GameStateDelta after every
+event. Both carry the version of the game state. A client that misses a delta asks for a new snapshot
+with a ResyncRequest.
+
+A Turn packet carries all the events of one player's turn. The server applies them together or not at all,
+and broadcasts one delta for the whole turn.'''
+
+# Length prefix of a framed packet: unsigned 4 byte int in network byte order.
+HEADER = struct.Struct('!I')
+
+# Upper limit of a single packet, anything larger is treated as a corrupt stream:
+MAX_PACKET_SIZE = 1 << 20
+
+# Binary codec:
+BINARY_MAGIC = 0xB5
+BINARY_VERSION = 5
+
+# Codecs known by this module, in order of preference:
+CODECS = ('binary', 'json')
+
+I32 = struct.Struct('!i')
+U16 = struct.Struct('!H')
 
 
 class Dict2Obj(object):
@@ -18,15 +55,182 @@ def get_events():
     return Event.__subclasses__()
 
 
+def encode_object(obj):
+    if isinstance(obj, Card):
+        return obj.to_dict()
+    # Packets nested in other packets, like the events of a Turn:
+    if isinstance(obj, DataPacket):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def decode_object(d):
+    if d.keys() == {"color", "number"}:
+        return card_from_dict(d)
+    if '__class__' in d:
+        d['__class__'] = getattr(sys.modules[__name__], d['__class__'])
+        return Dict2Obj(d)
+    return d
+
+
+def choose_codec(offered):
+
+    """ Returns the first codec from the client's list that this module knows, or json. """
+
+    for codec in offered:
+        if codec in CODECS:
+            return codec
+    return 'json'
+
+
 def load(packet):
-    d = json.loads(packet.decode('utf-8'))
-    d['__class__'] = getattr(sys.modules[__name__], d['__class__'])
+    if packet[0] == BINARY_MAGIC:
+        return load_binary(packet)
 
-    new_instance = Dict2Obj(d)
+    # The object hook turns the packet dictionaries into their DataPacket objects, from the inside out:
+    new_instance = json.loads(packet.decode('utf-8'), object_hook=decode_object)
 
     return new_instance
 
 
+def frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+class PacketDecoder:
+
+    """ Incremental decoder of a framed packet stream. Feed it whatever recv() returned, it buffers the partial
+    frames and hands out the packets that are complete:
+
+        decoder.feed(sock.recv(BUFFERSIZE))
+        for packet in decoder:
+            ...
+    """
+
+    def __init__(self, max_packet_size=MAX_PACKET_SIZE):
+        self.buffer = bytearray()
+        self.offset = 0                 # Start of the first frame not yet decoded
+        self.max_packet_size = max_packet_size
+
+    def feed(self, data):
+        # Drop the already decoded frames before growing the buffer:
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def next_payload(self):
+
+        """ Returns the payload of the next complete frame, or None if more data is needed. """
+
+        if len(self.buffer) - self.offset < HEADER.size:
+            return None
+
+        (size, ) = HEADER.unpack_from(self.buffer, self.offset)
+        if size > self.max_packet_size:
+            raise ValueError(f'Packet of {size} bytes exceeds the maximum of {self.max_packet_size} bytes.')
+
+        start = self.offset + HEADER.size
+        end = start + size
+        if len(self.buffer) < end:
+            return None
+
+        self.offset = end
+        return bytes(self.buffer[start:end])
+
+    def next_packet(self):
+        payload = self.next_payload()
+        if payload is None:
+            return None
+        return load(payload)
+
+    def __iter__(self):
+        while True:
+            packet = self.next_packet()
+            if packet is None:
+                return
+            yield packet
+
+
+def load_binary(packet):
+    reader = BinaryReader(packet)
+
+    version = reader.u8()
+    if version != BINARY_VERSION:
+        raise ValueError(f'Unsupported binary codec version: {version}')
+
+    packet_class = BINARY_PACKETS[reader.u8()]
+    return packet_class.read_binary(reader)
+
+
+class BinaryWriter:
+
+    """ Builds a binary payload. Card lists are written as their card codes, one byte each. """
+
+    def __init__(self, packet_type):
+        self.buffer = bytearray((BINARY_MAGIC, BINARY_VERSION, packet_type))
+
+    def u8(self, value):
+        self.buffer.append(value)
+
+    def u16(self, value):
+        self.buffer += U16.pack(value)
+
+    def i32(self, value):
+        self.buffer += I32.pack(value)
+
+    def string(self, value):
+        data = value.encode('utf-8')
+        self.u16(len(data))
+        self.buffer += data
+
+    def card(self, card):
+        self.buffer.append(card.code)
+
+    def cards(self, cards):
+        self.u16(len(cards))
+        self.buffer += bytes([card.code for card in cards])
+
+
+class BinaryReader:
+
+    """ Reads back the fields written by a BinaryWriter, in the same order. """
+
+    def __init__(self, packet):
+        self.data = packet
+        self.offset = 1     # Skip the magic byte
+
+    def u8(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def u16(self):
+        (value, ) = U16.unpack_from(self.data, self.offset)
+        self.offset += U16.size
+        return value
+
+    def i32(self):
+        (value, ) = I32.unpack_from(self.data, self.offset)
+        self.offset += I32.size
+        return value
+
+    def string(self):
+        size = self.u16()
+        value = self.data[self.offset:self.offset+size].decode('utf-8')
+        self.offset += size
+        return value
+
+    def card(self):
+        return CARDS[self.u8()]
+
+    def cards(self):
+        size = self.u16()
+        codes = self.data[self.offset:self.offset+size]
+        self.offset += size
+        return [CARDS[code] for code in codes]
+
+
 class DataPacket:
     def to_pickle(self):
         return pickle.dumps(self)
@@ -45,15 +249,45 @@ class DataPacket:
 
     def to_json(self):
         # d = self.to_dict()
-        return json.dumps(self.to_dict())
+        return json.dumps(self.to_dict(), default=encode_object)
+
+    def to_binary(self):
+        writer = BinaryWriter(BINARY_IDS[type(self)])
+        self.write_binary(writer)
+        return bytes(writer.buffer)
+
+    def to_bytes(self, codec='json'):
+        # Framed form, ready to be sent on the stream:
+        if codec == 'binary':
+            return frame(self.to_binary())
+        return frame(bytes(self.to_json(), 'utf-8'))
 
-    def to_bytes(self):
-        return bytes(self.to_json(), 'utf-8')
+    def write_binary(self, writer):
+        raise NotImplementedError
+
+    @classmethod
+    def read_binary(cls, reader):
+        raise NotImplementedError
 
 
 @dataclass
 class ConnectionAttempt(DataPacket):
     user_name: str
+    codecs: tuple = ('json', )      # Codecs the client can read, in order of preference
+    room: str = ''                  # Room to join, empty for any room that is waiting for players
+
+    def write_binary(self, writer):
+        writer.string(self.user_name)
+        writer.u8(len(self.codecs))
+        for codec in self.codecs:
+            writer.string(codec)
+        writer.string(self.room)
+
+    @classmethod
+    def read_binary(cls, reader):
+        user_name = reader.string()
+        codecs = tuple(reader.string() for _ in range(reader.u8()))
+        return cls(user_name, codecs, reader.string())
 
 
 @dataclass
@@ -61,6 +295,19 @@ class ConnectionConfirmed(DataPacket):
     confirmed: bool
     user_name: str
     player_id: int
+    codec: str = 'json'             # Codec picked by the server for everything after the handshake
+    room: str = ''                  # Room the player was placed in
+
+    def write_binary(self, writer):
+        writer.u8(self.confirmed)
+        writer.string(self.user_name)
+        writer.i32(self.player_id)
+        writer.string(self.codec)
+        writer.string(self.room)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(bool(reader.u8()), reader.string(), reader.i32(), reader.string(), reader.string())
 
 
 @dataclass
@@ -76,6 +323,8 @@ class GameStateUpdate(DataPacket):
     life_points: int
     current_player: int
 
+    version: int = 0
+
     def keys_to_ints(self):
 
         self.players = {int(player_id): name for player_id, name in self.players.items()}
@@ -83,11 +332,180 @@ class GameStateUpdate(DataPacket):
         self.player_hands = {int(idx): {int(ix): card for ix, card in hand.items()}
                              for idx, hand in self.player_hands.items()}
 
+    def write_binary(self, writer):
+        writer.u8(self.started)
+        writer.u8(self.info_points)
+        writer.u8(self.life_points)
+        writer.u8(self.current_player)
+
+        writer.u8(len(self.players))
+        for player_id, name in self.players.items():
+            writer.u8(int(player_id))
+            writer.string(name)
+
+        # Hand slots are numbered from 0, so only the cards are written:
+        writer.u8(len(self.player_hands))
+        for player_id, hand in self.player_hands.items():
+            writer.u8(int(player_id))
+            writer.cards(list(hand.values()))
+
+        writer.u8(len(self.table_stash))
+        for color, column in self.table_stash.items():
+            writer.u8(COLORS.index(color))
+            writer.cards(column)
+
+        writer.cards(self.discard_pile)
+        writer.i32(self.version)
+
+    @classmethod
+    def read_binary(cls, reader):
+        started = bool(reader.u8())
+        info_points = reader.u8()
+        life_points = reader.u8()
+        current_player = reader.u8()
+
+        players = {}
+        for _ in range(reader.u8()):
+            player_id = reader.u8()
+            players[player_id] = reader.string()
+
+        player_hands = {}
+        for _ in range(reader.u8()):
+            player_id = reader.u8()
+            player_hands[player_id] = dict(enumerate(reader.cards()))
+
+        table_stash = {}
+        for _ in range(reader.u8()):
+            color = COLORS[reader.u8()]
+            table_stash[color] = reader.cards()
+
+        discard_pile = reader.cards()
+        version = reader.i32()
+
+        return cls(started=started,
+                   players=players,
+                   player_hands=player_hands,
+                   table_stash=table_stash,
+                   discard_pile=discard_pile,
+                   info_points=info_points,
+                   life_points=life_points,
+                   current_player=current_player,
+                   version=version)
+
+    def apply_delta(self, delta):
+
+        """ Returns a new GameStateUpdate with the delta applied. Only the changed hands and table columns
+        are copied, the rest is shared with this one. The delta has to be the next version. """
+
+        assert delta.version == self.version + 1
+
+        player_hands = dict(self.player_hands)
+        for player_id, card_position, card in delta.hand_changes:
+            if player_hands[player_id] is self.player_hands[player_id]:
+                player_hands[player_id] = dict(player_hands[player_id])
+            player_hands[player_id][card_position] = card
+
+        table_stash = dict(self.table_stash)
+        for card in delta.table_added:
+            table_stash[card.color] = [*table_stash[card.color], card]
+
+        return replace(self,
+                       player_hands=player_hands,
+                       table_stash=table_stash,
+                       discard_pile=self.discard_pile + list(delta.discard_added),
+                       info_points=delta.info_points,
+                       life_points=delta.life_points,
+                       current_player=delta.current_player,
+                       version=delta.version)
+
+
+@dataclass
+class GameStateDelta(DataPacket):
+
+    """ The changes made to the game state by one event. """
+
+    version: int                # Version of the game state after the change
+    hand_changes: list          # (player_id, card_position, card) for every changed hand slot
+    table_added: list           # Cards added to the table stash
+    discard_added: list         # Cards added to the discard pile
+
+    info_points: int
+    life_points: int
+    current_player: int
+
+    def write_binary(self, writer):
+        writer.i32(self.version)
+
+        writer.u8(len(self.hand_changes))
+        for player_id, card_position, card in self.hand_changes:
+            writer.u8(player_id)
+            writer.u8(card_position)
+            writer.card(card)
+
+        writer.cards(self.table_added)
+        writer.cards(self.discard_added)
+
+        writer.u8(self.info_points)
+        writer.u8(self.life_points)
+        writer.u8(self.current_player)
+
+    @classmethod
+    def read_binary(cls, reader):
+        version = reader.i32()
+        hand_changes = [(reader.u8(), reader.u8(), reader.card()) for _ in range(reader.u8())]
+        table_added = reader.cards()
+        discard_added = reader.cards()
+
+        return cls(version=version,
+                   hand_changes=hand_changes,
+                   table_added=table_added,
+                   discard_added=discard_added,
+                   info_points=reader.u8(),
+                   life_points=reader.u8(),
+                   current_player=reader.u8())
+
+
+@dataclass
+class ResyncRequest(DataPacket):
+
+    """ Sent by a client that missed a delta, the server answers with a full GameStateUpdate. """
+
+    version: int                # Last version the client has
+
+    def write_binary(self, writer):
+        writer.i32(self.version)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(reader.i32())
+
+
+@dataclass
+class EventRejected(DataPacket):
+
+    """ Sent to a client whose event the server did not accept. """
+
+    version: int                # Version of the game state the event was rejected at
+
+    def write_binary(self, writer):
+        writer.i32(self.version)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(reader.i32())
+
 
 @dataclass
 class Event(DataPacket):
     player: int
 
+    def write_binary(self, writer):
+        writer.i32(self.player)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(reader.i32())
+
 
 @dataclass
 class InfoUsed(Event):
@@ -106,11 +524,58 @@ class NextTurn(Event):
 
 @dataclass
 class CardBurned(Event):
-    card: dict
+    card: Card
     card_position: int
 
+    def write_binary(self, writer):
+        writer.i32(self.player)
+        writer.card(self.card)
+        writer.u8(self.card_position)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(reader.i32(), reader.card(), reader.u8())
+
 
 @dataclass
 class CardPlaced(Event):
-    card: dict
+    card: Card
     card_position: int
+
+    def write_binary(self, writer):
+        writer.i32(self.player)
+        writer.card(self.card)
+        writer.u8(self.card_position)
+
+    @classmethod
+    def read_binary(cls, reader):
+        return cls(reader.i32(), reader.card(), reader.u8())
+
+
+@dataclass
+class Turn(Event):
+
+    """ All the events of one turn of the player, e.g. CardBurned, CardPull and NextTurn. They are applied as one
+    update: if any of them is not possible, none of them is applied. """
+
+    events: list
+
+    def write_binary(self, writer):
+        writer.i32(self.player)
+        writer.u8(len(self.events))
+        for event in self.events:
+            writer.u8(BINARY_IDS[type(event)])
+            event.write_binary(writer)
+
+    @classmethod
+    def read_binary(cls, reader):
+        player = reader.i32()
+        events = [BINARY_PACKETS[reader.u8()].read_binary(reader) for _ in range(reader.u8())]
+        return cls(player, events)
+
+
+# Packet type ids of the binary codec. Only append to this list, the ids are part of the wire format.
+BINARY_PACKETS = [ConnectionAttempt, ConnectionConfirmed, GameStateUpdate,
+                  InfoUsed, CardPull, NextTurn, CardBurned, CardPlaced,
+                  GameStateDelta, ResyncRequest, EventRejected, Turn]
+BINARY_IDS = {packet_class: packet_id for packet_id, packet_class in enumerate(BINARY_PACKETS)}
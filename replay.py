@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import mmap
+import time
+import pickle
+import logging
+import argparse
+import packets
+from event_log import VERSION, valid_room_name
+from game_logic import GameState
+
+''' This module records finished and running games and replays them turn by turn.
+
+A recording starts with a header frame holding the number of players, the seed of the deck and the player
+names, which is enough to deal the game again. It is followed by one frame per accepted event, in the same
+format as the records of the event log. The server writes recordings when it runs with --record DIR.
+
+The Replay reads a recording through mmap. On the first open it replays the whole game once and keeps a
+pickled GameState every CHECKPOINT_INTERVAL events, together with the byte offset of every event and the
+first event of every turn. This index is stored next to the recording (<file>.idx). Seeking to any turn then
+loads the checkpoint before it and replays only the events in between.
+
+    python replay.py GAME.hanabi                    Summary of the game
+    python replay.py GAME.hanabi --turn 12          Game state at the start of turn 12
+    python replay.py GAME.hanabi --play             Playback in the GameWindow (LEFT/RIGHT, SPACE)
+    python replay.py GAME.hanabi --headless         Drive the GameWindow through every turn without a display'''
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_INTERVAL = 32        # Events between two stored game states of the index
+RECORDING_SUFFIX = '.hanabi'
+
+
+class GameRecorder:
+
+    """ Writes the recording of one game. The file is named after the room and the seed of the deck, so a room
+    recovered after a restart keeps writing to the same recording. """
+
+    def __init__(self, directory, room_name, n_players, seed, players):
+        # The room name is part of the file name, like in the event log:
+        if not valid_room_name(room_name):
+            raise ValueError(f'Room name {room_name!r} cannot be used as a file name.')
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{room_name}-{seed}{RECORDING_SUFFIX}')
+        self.file = open(self.path, 'ab')
+
+        if self.file.tell() == 0:
+            header = {'room': room_name, 'n_players': n_players, 'seed': seed, 'players': players}
+            self.file.write(packets.frame(json.dumps(header).encode('utf-8')))
+            self.file.flush()
+
+    def append(self, version, event):
+        self.file.write(packets.frame(VERSION.pack(version) + event.to_binary()))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Replay:
+
+    """ A recorded game that can be rebuilt at any event or turn. """
+
+    def __init__(self, path, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The header frame:
+        (size, ) = packets.HEADER.unpack_from(self.data, 0)
+        header = json.loads(self.data[packets.HEADER.size:packets.HEADER.size + size].decode('utf-8'))
+        self.room = header['room']
+        self.n_players = header['n_players']
+        self.seed = header['seed']
+        self.players = {int(player_id): name for player_id, name in header['players'].items()}
+
+        self.checkpoint_interval = checkpoint_interval
+        self.offsets = []               # Byte offset of the frame of every event
+        self.checkpoints = {}           # KEY: number of events applied   VALUE: pickled GameState
+        self.turn_starts = []           # Index of the first event of every turn
+
+        if not self.load_index():
+            self.build_index(packets.HEADER.size + size)
+            self.save_index()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    def load_index(self):
+
+        """ Uses the stored index if it was built for this recording at its current size. """
+
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+
+        if index['size'] != len(self.data) or index['interval'] != self.checkpoint_interval:
+            return False
+
+        self.offsets = index['offsets']
+        self.checkpoints = index['checkpoints']
+        self.turn_starts = index['turn_starts']
+        return True
+
+    def save_index(self):
+        index = {'size': len(self.data),
+                 'interval': self.checkpoint_interval,
+                 'offsets': self.offsets,
+                 'checkpoints': self.checkpoints,
+                 'turn_starts': self.turn_starts}
+
+        try:
+            with open(self.index_path, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as ex:
+            logger.warning('Could not store the replay index: %s', ex)
+
+    def build_index(self, offset):
+
+        """ Finds the events in the file, then replays the game once to store the checkpoints. """
+
+        # Only the length prefixes are read to find the frames. A frame cut off at the end is left out:
+        while offset + packets.HEADER.size <= len(self.data):
+            (size, ) = packets.HEADER.unpack_from(self.data, offset)
+            if offset + packets.HEADER.size + size > len(self.data):
+                break
+            self.offsets.append(offset)
+            offset += packets.HEADER.size + size
+
+        game_state = self.initial_state()
+        self.checkpoints = {0: pickle.dumps(game_state, protocol=pickle.HIGHEST_PROTOCOL)}
+        self.turn_starts = [0]
+
+        for index in range(len(self)):
+            player = game_state.current_player
+            game_state.update(self.event(index))
+
+            # A turn ends when the next player is up:
+            if game_state.current_player != player:
+                self.turn_starts.append(index + 1)
+
+            if (index + 1) % self.checkpoint_interval == 0:
+                self.checkpoints[index + 1] = pickle.dumps(game_state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def initial_state(self):
+        game_state = GameState(self.n_players, self.seed)
+        game_state.started = True
+        return game_state
+
+    def event(self, index):
+        offset = self.offsets[index]
+        (size, ) = packets.HEADER.unpack_from(self.data, offset)
+        start = offset + packets.HEADER.size + VERSION.size
+        return packets.load(self.data[start:offset + packets.HEADER.size + size])
+
+    def n_turns(self):
+        return len(self.turn_starts)
+
+    def state_at(self, n_events):
+
+        """ The GameState after the first n_events events: the last checkpoint before it, plus the rest. """
+
+        n_events = max(0, min(n_events, len(self)))
+        start = (n_events // self.checkpoint_interval) * self.checkpoint_interval
+        game_state = pickle.loads(self.checkpoints[start])
+
+        for index in range(start, n_events):
+            game_state.update(self.event(index))
+
+        return game_state
+
+    def state_at_turn(self, turn):
+
+        """ The GameState at the start of the given turn, counted from 0. """
+
+        turn = max(0, min(turn, self.n_turns() - 1))
+        return self.state_at(self.turn_starts[turn])
+
+
+def find_recordings(path):
+
+    """ The recordings in a directory, or the given file. """
+
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(RECORDING_SUFFIX))
+    return [path]
+
+
+def summary(replay):
+    final = replay.state_at(len(replay))
+    score = sum(len(column) for column in final.table_stash.values())
+    return (f'{os.path.basename(replay.path)}: room {replay.room}, players {list(replay.players.values())}, '
+            f'{len(replay)} events, {replay.n_turns()} turns, score {score}, '
+            f'life points {final.life_points}, {"lost" if final.lost else "not lost"}')
+
+
+# --- Driving the GameWindow --- #
+
+class Playback:
+
+    """ Shows a replay in a GameWindow. LEFT and RIGHT step one turn, SPACE plays and pauses. """
+
+    def __init__(self, window, replay, turn=0, speed=1.0):
+        self.window = window
+        self.replay = replay
+        self.turn = turn
+        self.speed = speed              # Seconds per turn while playing
+        self.playing = False
+
+        self.window.player_id = 0
+        self.window.connection = True
+        self.show(turn)
+
+    def show(self, turn):
+        self.turn = max(0, min(turn, self.replay.n_turns() - 1))
+        game_state = self.replay.state_at_turn(self.turn)
+
+        # The window takes it like a full game state from the server; only the changed card tabs are updated:
+        self.window.update_server_state(game_state.to_packet(self.replay.players))
+        self.window.show_message(f'Turn {self.turn + 1}/{self.replay.n_turns()}')
+
+    def step(self, delta_time=None):
+        if self.turn + 1 >= self.replay.n_turns():
+            self.playing = False
+            return
+        self.show(self.turn + 1)
+
+    def on_key_press(self, key, modifiers):
+        import arcade
+
+        if key == arcade.key.RIGHT:
+            self.show(self.turn + 1)
+        elif key == arcade.key.LEFT:
+            self.show(self.turn - 1)
+        elif key == arcade.key.SPACE:
+            self.playing = not self.playing
+            if self.playing:
+                arcade.schedule(self.step_playing, self.speed)
+            else:
+                arcade.unschedule(self.step_playing)
+
+    def step_playing(self, delta_time):
+        import arcade
+
+        self.step()
+        if not self.playing:
+            arcade.unschedule(self.step_playing)
+
+
+def play(replay, turn=0, speed=1.0):
+    import arcade
+    from game_window import GameWindow
+
+    window = GameWindow(client=None)
+    playback = Playback(window, replay, turn, speed)
+    window.on_key_press = playback.on_key_press
+    arcade.run()
+
+
+def drive_headless(replays):
+
+    """ Feeds every turn of the replays to one GameWindow without a display and returns the seconds taken. """
+
+    # Has to be set before arcade is imported:
+    os.environ.setdefault('ARCADE_HEADLESS', '1')
+    from game_window import GameWindow
+
+    window = GameWindow(client=None)
+    start = time.perf_counter()
+    n_turns = 0
+
+    for replay in replays:
+        window.reset_game()
+        playback = Playback(window, replay)
+        while playback.turn + 1 < replay.n_turns():
+            playback.step()
+            window.on_draw()
+        n_turns += replay.n_turns()
+
+    elapsed = time.perf_counter() - start
+    print(f'Drove the GameWindow through {n_turns} turns of {len(replays)} game(s) in {elapsed:.3f} s')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded PyHanabi games')
+    parser.add_argument('path', help='a recording, or a directory of recordings')
+    parser.add_argument('--turn', type=int, default=None, help='print the game state at the start of this turn')
+    parser.add_argument('--play', action='store_true', help='play the game back in the GameWindow')
+    parser.add_argument('--speed', type=float, default=1.0, help='seconds per turn in playback')
+    parser.add_argument('--headless', action='store_true', help='drive the GameWindow without a display')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    replays = [Replay(path) for path in find_recordings(args.path)]
+    print(f'Opened {len(replays)} recording(s) in {time.perf_counter() - start:.3f} s')
+
+    if args.headless:
+        drive_headless(replays)
+
+    elif args.play:
+        play(replays[0], args.turn or 0, args.speed)
+
+    elif args.turn is not None:
+        for replay in replays:
+            start = time.perf_counter()
+            game_state = replay.state_at_turn(args.turn)
+            elapsed = time.perf_counter() - start
+            print(f'{os.path.basename(replay.path)}, turn {args.turn} (version {game_state.version}), '
+                  f'rebuilt in {elapsed * 1000:.2f} ms:')
+            print(f'    Hands: {game_state.player_hands}')
+            print(f'    Table: { {col: column.max() for col, column in game_state.table_stash.items()} }')
+            print(f'    Info points: {game_state.info_points}, life points: {game_state.life_points}, '
+                  f'current player: {game_state.current_player}')
+
+    else:
+        for replay in replays:
+            print(summary(replay))
+
+    for replay in replays:
+        replay.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
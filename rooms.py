@@ -0,0 +1,446 @@
+import time
+import pprint
+import logging
+import packets
+from threading import Thread, Lock, RLock
+from settings import *
+from game_logic import GameState
+from replay import GameRecorder
+from event_log import valid_room_name
+from metrics import metrics
+
+''' This module defines the game rooms of the server. Each Room holds one GameState with its own players and
+clients, and broadcasts only go to the clients of that room. The RoomRegistry keeps the rooms of a server,
+places the connecting players into them and removes the rooms that are left empty. A finished game is removed
+FINISHED_ROOM_GRACE seconds after its end, even if players are still looking at it.
+
+With an EventLogStore every started game is written to disk (see event_log). After a restart the registry
+opens the logged games again, and the players get their seats back by joining the room with their name. A
+recovered game that nobody came back to within RECOVERED_ROOM_TIMEOUT seconds is removed.'''
+
+REAP_INTERVAL = 5.0         # Seconds between two checks for finished and unclaimed rooms
+
+
+class BroadcastCache:
+
+    """ Encoded broadcasts of one game state version. Every client with the same codec gets the same bytes,
+    so each broadcast is serialized once per codec instead of once per client.
+
+    The cache is keyed by GameState.version, which only changes when GameState.update returns True.
+    Changes made outside of update (players joining, the game starting) have to call clear(). """
+
+    def __init__(self):
+        self.version = None
+        self.encoded = {}
+
+    def get(self, version, key, encode):
+        if version != self.version:
+            self.version = version
+            self.encoded = {}
+
+        data = self.encoded.get(key)
+        if data is None:
+            start = time.perf_counter()
+            data = self.encoded[key] = encode()
+            metrics.observe('serialize', time.perf_counter() - start)
+            metrics.count('bytes_serialized', len(data))
+        return data
+
+    def clear(self):
+        self.version = None
+        self.encoded = {}
+
+
+logger = logging.getLogger(__name__)
+
+
+def dump_game_state(game_state):
+    logger.debug('Game state:\n%s', pprint.pformat(game_state.__dict__))
+
+
+class Room:
+
+    """ One game table: the Game state, the players sitting at it and their connected clients. """
+
+    def __init__(self, name, n_players=MAX_PLAYERS, event_log=None, recordings_dir=None):
+        self.name = name
+        self.n_players = n_players
+        self.clients = set()
+
+        # Player connections:
+        self.player_count = 0
+        self.players = {}
+        self.seats = {}                 # KEY: player_id   VALUE: client connected to that seat
+        self.bots = set()               # BotPlayers seated by the server, they are clients of the room too
+
+        # Game State:
+        self.GS = GameState(n_players)
+        self.lock = RLock()             # Keeps the updates and their delta broadcasts in version order
+        self.broadcast_cache = BroadcastCache()
+
+        # Opt-in debug output, called with the game state after every broadcast:
+        self.state_dump = dump_game_state if DEBUG_STATE_DUMP else None
+
+        # EventLog of the room for crash recovery, if the server keeps one:
+        self.event_log = event_log
+
+        # Recording of the game for replays, started with the game if the server records them:
+        self.recordings_dir = recordings_dir
+        self.recorder = None
+
+        # When the game was recovered from the event log and when it was first seen finished, for the registry:
+        self.recovered_at = None
+        self.finished_at = None
+
+    def is_open(self):
+        return not self.GS.started and self.player_count < self.n_players
+
+    def is_finished(self):
+        return self.GS.lost or self.GS.completed()
+
+    def has_humans(self):
+        return bool(self.clients - self.bots)
+
+    def connect_player(self, client, data):
+
+        """ Connection handshake. Returns False if the connection was denied. """
+
+        with self.lock:
+
+            # Accept players until we reach MAX count:
+            if self.is_open():
+
+                # Store player data in the room's dictionary:
+                player_id = self.player_count
+                self.add_player(player_id, data.user_name)
+                self.clients.add(client)
+                self.seats[player_id] = client
+
+                # Pick the codec for the game state broadcasts from the ones the client can read:
+                codec = packets.choose_codec(data.codecs)
+
+                # Confirm connection handshake and player id sync:
+                response = packets.ConnectionConfirmed(True, data.user_name, player_id, codec, self.name)
+                client.send_game_state(response.to_bytes())
+                client.codec = codec
+
+                # Increase player count, if we reached max_player: start the game, otherwise show the new player:
+                self.player_count += 1
+                if self.player_count == self.n_players:
+                    self.start_game()
+                else:
+                    self.broadcast_game_state_update()
+
+                return True
+
+            # A player coming back to a running game, e.g. after the server was restarted:
+            elif self.free_seat(data.user_name) is not None:
+                player_id = self.free_seat(data.user_name)
+                self.clients.add(client)
+                self.seats[player_id] = client
+
+                codec = packets.choose_codec(data.codecs)
+                response = packets.ConnectionConfirmed(True, data.user_name, player_id, codec, self.name)
+                client.send_game_state(response.to_bytes())
+                client.codec = codec
+
+                logger.info('%s is back in room %s.', data.user_name, self.name)
+                self.send_game_state_snapshot(client)
+                return True
+
+            else:
+
+                # Deny connection when above MAX player count is reached and disconnect the client:
+                response = packets.ConnectionConfirmed(False, data.user_name, 999, room=self.name)
+                client.send_game_state(response.to_bytes())
+
+                return False
+
+    def add_player(self, player_id, user_name):
+        with self.lock:
+            self.players[player_id] = user_name
+            self.broadcast_cache.clear()
+
+    def free_seat(self, user_name):
+
+        """ Returns the id of the player with this name whose client is gone, or None. """
+
+        if not self.GS.started:
+            return None
+
+        for player_id, name in self.players.items():
+            if name == user_name and player_id not in self.seats:
+                return player_id
+        return None
+
+    def add_bot(self, bot):
+
+        """ Seats a bot the same way as a connecting player. Returns False if there was no seat for it. """
+
+        with self.lock:
+            attempt = packets.ConnectionAttempt(bot.user_name, (bot.codec, ), self.name)
+            if not self.connect_player(bot, attempt):
+                return False
+
+            player_id = next(player_id for player_id, client in self.seats.items() if client is bot)
+            self.bots.add(bot)
+            bot.start(self, player_id)
+            logger.info('%s took seat %d in room %s.', bot.user_name, player_id, self.name)
+            return True
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+            for player_id, seat_client in tuple(self.seats.items()):
+                if seat_client is client:
+                    del self.seats[player_id]
+
+    def restore(self, players, game_state):
+
+        """ Continues a game recovered from the event log. Nobody is connected until the players come back. """
+
+        with self.lock:
+            self.players = players
+            self.player_count = len(players)
+            self.GS = game_state
+            self.broadcast_cache.clear()
+            self.write_snapshot()
+            self.start_recording()
+            self.recovered_at = time.monotonic()
+
+    def start_recording(self):
+        if self.recordings_dir is not None and self.recorder is None:
+            self.recorder = GameRecorder(self.recordings_dir, self.name, self.GS.n_players, self.GS.seed,
+                                         self.players)
+
+    def close(self):
+        with self.lock:
+            for bot in self.bots:
+                bot.stop()
+
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+            # The registry closes the log. Players still in a closed room must not write to it anymore:
+            self.event_log = None
+
+    def write_snapshot(self):
+        if self.event_log is not None:
+            self.event_log.write_snapshot(self.players, self.GS)
+
+    def broadcast_game_state_update(self):
+
+        """ Send the full GS game state to all the clients in the room."""
+
+        with self.lock:
+            metrics.count('broadcasts_snapshot')
+            for client in tuple(self.clients):
+                self.send_game_state_snapshot(client)
+
+            if self.state_dump is not None:
+                self.state_dump(self.GS)
+
+    def broadcast_game_state_delta(self):
+
+        """ Send the changes of the last GS update to all the clients in the room."""
+
+        with self.lock:
+            metrics.count('broadcasts_delta')
+            for client in tuple(self.clients):
+                data = self.broadcast_cache.get(self.GS.version, ('delta', client.codec),
+                                                lambda: self.GS.last_delta.to_bytes(client.codec))
+                self.send(client, data)
+
+            if self.state_dump is not None:
+                self.state_dump(self.GS)
+
+    def send_game_state_snapshot(self, client):
+        with self.lock:
+            data = self.broadcast_cache.get(self.GS.version, ('snapshot', client.codec),
+                                            lambda: self.GS.to_bytes(self.players, client.codec))
+            self.send(client, data)
+
+    @staticmethod
+    def send(client, data):
+        start = time.perf_counter()
+        client.send_game_state(data)
+        metrics.observe('send', time.perf_counter() - start)
+        metrics.count('bytes_sent', len(data))
+
+    def start_game(self):
+        logger.info('Starting game in room %s...', self.name)
+        with self.lock:
+            self.GS.started = True
+            self.broadcast_cache.clear()
+            self.write_snapshot()
+            self.start_recording()
+        self.broadcast_game_state_update()
+
+    def update_game_state(self, event):
+        with metrics.timer('game_state_update'):
+            changed = self.GS.update(event=event)
+
+        if not changed:
+            metrics.count('events_rejected')
+            return False
+        metrics.count('events_accepted')
+
+        # Log the accepted event, every now and then the whole game state instead:
+        if self.event_log is not None and self.event_log.append(self.GS.version, event):
+            self.write_snapshot()
+
+        if self.recorder is not None:
+            self.recorder.append(self.GS.version, event)
+
+        return True
+
+    def handle_event(self, event, client=None):
+
+        """ Update the game state with a player event and broadcast the changes if it was accepted.
+        Otherwise the client that sent it is told, so it can roll back its prediction. """
+
+        with self.lock:
+            if self.update_game_state(event=event):
+                self.broadcast_game_state_delta()
+
+            elif client is not None:
+                client.send_game_state(packets.EventRejected(self.GS.version).to_bytes(client.codec))
+
+
+class RoomRegistry:
+
+    """ All the rooms of one server, by name. """
+
+    def __init__(self, event_logs=None, recordings_dir=None, room_prefix='room'):
+        self.rooms = {}
+        self.lock = Lock()
+        self.room_prefix = room_prefix  # The rooms that are opened automatically are named <prefix>-<counter>
+        self.room_counter = 0
+        self.recordings_dir = recordings_dir
+
+        # No new rooms are opened while the server is draining, the running games are finished:
+        self.accepting_new_rooms = True
+
+        # EventLogStore of the server, the games found in it are continued:
+        self.event_logs = event_logs
+        if event_logs is not None:
+            self.recover_rooms()
+
+        # Removes the finished games and the recovered games nobody came back to:
+        self.reap_thread = Thread(target=self.reap_loop, daemon=True)
+        self.reap_thread.start()
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def join(self, client, data):
+
+        """ Places a connecting player into the requested room, or into the first open room when no room is
+        named. Missing rooms are created. Returns the room, or None if the player was denied. """
+
+        with self.lock:
+            name = getattr(data, 'room', '')
+
+            # The name is used for the files of the room:
+            if name and not valid_room_name(name):
+                logger.warning('Denied %s the room name %r.', data.user_name, name)
+                return self.deny(client, data, name)
+
+            if name:
+                room = self.rooms.get(name)
+            else:
+                room = self.find_open_room()
+
+            if room is None:
+                if not self.accepting_new_rooms:
+                    logger.info('Not opening a room for %s, the server is draining.', data.user_name)
+                    return self.deny(client, data, name)
+                room = self.create_room(name)
+
+            # A denied room is left as it is: it is full, or it is a recovered game waiting for its players:
+            if not room.connect_player(client, data):
+                return None
+
+            return room
+
+    @staticmethod
+    def deny(client, data, name):
+        response = packets.ConnectionConfirmed(False, data.user_name, 999, room=name)
+        client.send_game_state(response.to_bytes())
+        return None
+
+    def find_open_room(self):
+        for room in self.rooms.values():
+            if room.is_open():
+                return room
+        return None
+
+    def create_room(self, name=''):
+        if not name:
+            self.room_counter += 1
+            name = f'{self.room_prefix}-{self.room_counter}'
+            while name in self.rooms:
+                self.room_counter += 1
+                name = f'{self.room_prefix}-{self.room_counter}'
+
+        event_log = self.event_logs.open(name) if self.event_logs is not None else None
+        room = Room(name, event_log=event_log, recordings_dir=self.recordings_dir)
+        self.rooms[name] = room
+        logger.info('Opened room %s. Rooms: %d', name, len(self.rooms))
+        return room
+
+    def recover_rooms(self):
+        for name, players, game_state in self.event_logs.recover():
+            room = Room(name, game_state.n_players, event_log=self.event_logs.open(name),
+                        recordings_dir=self.recordings_dir)
+            room.restore(players, game_state)
+            self.rooms[name] = room
+            logger.info('Recovered room %s at version %d.', name, game_state.version)
+
+    def leave(self, client, room):
+
+        """ Takes the client out of its room and removes the room once nobody but bots is left in it. """
+
+        room.remove_client(client)
+        with self.lock:
+            self.reclaim_locked(room)
+
+    def reclaim_locked(self, room):
+        if not room.has_humans() and self.rooms.get(room.name) is room:
+            self.close_room_locked(room, 'finished' if room.is_finished() else 'abandoned')
+
+    def close_room_locked(self, room, state):
+        del self.rooms[room.name]
+        room.close()
+        logger.info('Closed %s room %s. Rooms: %d', state, room.name, len(self.rooms))
+
+        # The game does not need to be recovered anymore:
+        if self.event_logs is not None:
+            self.event_logs.close(room.name, delete=True)
+
+    def reap_loop(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            self.reap()
+
+    def reap(self, now=None):
+
+        """ Closes the games that finished FINISHED_ROOM_GRACE seconds ago, and the recovered games that
+        nobody came back to within RECOVERED_ROOM_TIMEOUT seconds. """
+
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            for room in tuple(self.rooms.values()):
+                with room.lock:
+                    if room.is_finished():
+                        if room.finished_at is None:
+                            room.finished_at = now
+                        elif now - room.finished_at >= FINISHED_ROOM_GRACE:
+                            self.close_room_locked(room, 'finished')
+
+                    # A player that came back and left again closes the room in reclaim_locked():
+                    elif room.recovered_at is not None and not room.has_humans() \
+                            and now - room.recovered_at >= RECOVERED_ROOM_TIMEOUT:
+                        self.close_room_locked(room, 'unclaimed')
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import packets
+from settings import HOST, PORT, EVENT_LOG_DIR, RECORDINGS_DIR, BOT_FILL_DELAY, BOT_TIME_BUDGET
+from server_socketserver import GameServer
+from metrics import metrics
+
+''' This module runs the GameServer on a single asyncio event loop instead of one thread per client.
+Select it with: python server_socketserver.py --asyncio
+
+Every connection has a bounded queue of outgoing data and a writer task that drains it. Broadcasts only
+enqueue, so a slow client never blocks the others. When the queue of a client is full, the broadcast is
+dropped for that client; it will see a gap in the delta versions and ask for a full game state.'''
+
+logger = logging.getLogger(__name__)
+
+# Outgoing packets buffered per connection before broadcasts are dropped for it:
+WRITE_QUEUE_SIZE = 64
+
+
+class Connection:
+
+    """ One connected client. It is handled the same way as a RequestHandler of the threaded server. """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+
+        self.codec = 'json'             # Codec negotiated in the connection handshake
+        self.room = None                # Game room, set by the connection handshake
+        self.queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+    def send_game_state(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            metrics.count('broadcasts_dropped')
+            logger.warning('Write queue of %s is full, dropping a broadcast.', self.client_address)
+
+    async def run(self):
+        logger.info('Connecting client with address: %s.', self.client_address)
+        self.server.add_client(self)
+        writer_task = asyncio.create_task(self.write_loop())
+
+        try:
+            await self.read_loop()
+        except ConnectionError as ex:
+            logger.info('Client disconnected: %s', ex)
+        finally:
+            logger.info('Disconnecting client with address: %s!', self.client_address)
+            self.server.remove_client(self)
+
+            # Let the writer send what is already queued (e.g. a denied handshake), then close:
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                writer_task.cancel()
+            await asyncio.gather(writer_task, return_exceptions=True)
+            self.writer.close()
+
+    async def read_loop(self):
+
+        """ Wait for data and cut it into packets, until the client closes the connection or gets
+        disconnected by the server. """
+
+        decoder = packets.PacketDecoder()
+
+        while True:
+            data = await self.reader.read(self.server.BUFFERSIZE)
+
+            # An empty read means the client closed the connection:
+            if not data:
+                logger.info('Client closed the connection.')
+                return
+
+            decoder.feed(data)
+            if not self.server.handle_packets(self, decoder):
+                return
+
+    async def write_loop(self):
+        while True:
+            data = await self.queue.get()
+            if data is None:
+                return
+
+            try:
+                self.writer.write(data)
+                await self.writer.drain()       # Wait here while the socket buffer of a slow client is full
+            except ConnectionError as ex:
+                logger.warning('Sending to %s failed: %s', self.client_address, ex)
+                return
+
+
+class AsyncServer(GameServer):
+
+    """ Handle TCP connections on one asyncio event loop and all Player Events to update and broadcast
+    the Game state """
+
+    def __init__(self, host=HOST, port=PORT, log_dir=EVENT_LOG_DIR, recordings_dir=RECORDINGS_DIR,
+                 bot_delay=BOT_FILL_DELAY, bot_budget=BOT_TIME_BUDGET):
+        super().__init__(log_dir, recordings_dir, bot_delay, bot_budget)
+        self.HOST = host
+        self.PORT = port
+        self.loop = None
+
+    # The rooms are only used from the event loop, the bots' Turns and the seat timers are passed to it:
+    def call_soon(self, function):
+        self.loop.call_soon_threadsafe(function)
+
+    def call_later(self, delay, function):
+        self.loop.call_later(delay, function)
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.on_connection, self.HOST, self.PORT)
+        self.PORT = server.sockets[0].getsockname()[1]      # The bound port, when port 0 asked for any free one
+
+        async with server:
+            await server.serve_forever()
+
+    async def on_connection(self, reader, writer):
+        await Connection(self, reader, writer).run()
+
+
+def main(host=HOST, port=PORT, log_dir=EVENT_LOG_DIR, recordings_dir=RECORDINGS_DIR, bot_delay=BOT_FILL_DELAY,
+         bot_budget=BOT_TIME_BUDGET):
+    server = AsyncServer(host, port, log_dir, recordings_dir, bot_delay, bot_budget)
+    logger.info('Waiting for connections...')
+    asyncio.run(server.serve_forever())
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,515 @@
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+import selectors
+import functools
+import multiprocessing
+from threading import Thread, Lock
+import packets
+from settings import (HOST, PORT, MAX_PLAYERS, EVENT_LOG_DIR, RECORDINGS_DIR, LOG_LEVEL, STATS_INTERVAL, STATS_PORT,
+                      BOT_FILL_DELAY, BOT_TIME_BUDGET)
+from server_socketserver import GameServer, RequestHandler
+from metrics import Metrics, metrics, process_stats, serve_stats, dump_periodically, StatsRequestHandler
+from log import setup_logging
+
+''' A server that runs the games in several worker processes, so they are not limited to the one core a
+Python process can use. The front process only accepts the connections: it peeks at the ConnectionAttempt
+of a new client without reading it, picks a worker for the room and hands the socket over to it. From then on
+the client talks to the worker directly, with the same RequestHandler and GameServer as the threaded server.
+
+The workers share nothing. Every room lives in exactly one worker, with its own event logs in
+<log dir>/worker-<n>. A room is routed
+
+    by name, to the worker it was sent to first, or to the worker with the fewest rooms for a new name
+    without a name, to the worker that is filling rooms; it changes every MAX_PLAYERS players
+    w<n>-room-<k>, the names the workers give to those rooms, to worker n
+
+Draining a worker stops new rooms on it; it is stopped once its games are over, and replaced by a new worker
+unless the whole server is shutting down. SIGTERM or Ctrl+C drains every worker and exits when they are done,
+a second one stops them right away.
+
+    python server_sharded.py --workers 4 --stats-port 10001
+    curl http://localhost:10001/                The stats of all the workers together, and of each worker
+    curl -X POST http://localhost:10001/drain/2'''
+
+logger = logging.getLogger(__name__)
+
+HANDSHAKE_TIMEOUT = 10.0        # Seconds a new connection has to send its ConnectionAttempt
+HANDSHAKE_MAX_SIZE = 4096       # Bytes, a larger first packet is not a ConnectionAttempt
+STATS_PUSH_INTERVAL = 1.0       # Seconds between the stats a worker sends to the front
+DRAIN_TIMEOUT = 3600.0          # Seconds a draining worker has to finish its games before it is stopped
+ROUTE_GRACE = 10.0              # Seconds a route to a room is kept before the worker reports the room
+
+AUTO_ROOM_NAME = re.compile(r'w(\d+)-room-\d+$')
+
+# The front has threads running when it starts a replacement worker, which does not go well with fork:
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+# --- Worker process --- #
+
+class WorkerServer(GameServer):
+
+    """ The GameServer of a worker process. It gets the connected sockets from the front instead of listening,
+    and handles each of them on its own thread like the threaded server. """
+
+    def __init__(self, index, conn, log_dir=EVENT_LOG_DIR, recordings_dir=RECORDINGS_DIR, bot_delay=BOT_FILL_DELAY,
+                 bot_budget=BOT_TIME_BUDGET):
+        super().__init__(os.path.join(log_dir, f'worker-{index}') if log_dir else None, recordings_dir, bot_delay,
+                         bot_budget)
+        self.index = index
+        self.conn = conn                    # Pipe to the front
+        self.send_lock = Lock()
+        self.rooms.room_prefix = f'w{index}-room'
+
+    def send_to_front(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def serve(self):
+
+        """ Handles the messages of the front until it closes the pipe. """
+
+        Thread(target=self.push_stats, daemon=True).start()
+
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                return
+
+            if message[0] == 'connection':
+                _, sock, address = message
+                Thread(target=self.handle_connection, args=(sock, address), daemon=True).start()
+
+            elif message[0] == 'drain':
+                logger.info('Worker %d is draining, no new rooms.', self.index)
+                self.rooms.accepting_new_rooms = False
+
+    def handle_connection(self, sock, address):
+        try:
+            RequestHandler(sock, address, self)
+        except Exception:
+            logger.exception('Connection of %s failed.', address)
+        finally:
+            sock.close()
+
+    def push_stats(self):
+        # The first report right away, it tells the front about the recovered rooms:
+        while True:
+            try:
+                self.send_to_front(('stats', metrics.export(), list(self.rooms.rooms)))
+            except OSError:
+                return
+            time.sleep(STATS_PUSH_INTERVAL)
+
+
+def run_worker(index, conn, log_dir, recordings_dir, log_level, bot_delay, bot_budget):
+    setup_logging(log_level)
+    # Ctrl+C and a stop of the whole process group reach the workers too, the front decides when they stop:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    server = WorkerServer(index, conn, log_dir, recordings_dir, bot_delay, bot_budget)
+    logger.info('Worker %d is up with %d recovered rooms.', index, len(server.rooms))
+    server.serve()
+
+
+# --- Front process --- #
+
+class Worker:
+
+    """ The front's view of one worker process. """
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.send_lock = Lock()             # The stats thread drains, the main loop hands over the connections
+        self.rooms = set()                  # Names of the rooms the worker reported, or that were routed to it
+        self.routed_at = {}                 # KEY: room name   VALUE: time it was routed, until it is reported
+        self.exported = None                # The last metrics export the worker sent
+        self.draining_since = None
+
+    @property
+    def draining(self):
+        return self.draining_since is not None
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class StatsHandler(StatsRequestHandler):
+
+    """ The stats of the front, and POST /drain/<worker> to drain one worker. """
+
+    def do_POST(self):
+        match = re.fullmatch(r'/drain/(\d+)', self.path)
+        drained = match is not None and self.server.metrics.drain(int(match.group(1)))
+
+        self.send_response(200 if drained else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class ShardedServer:
+
+    """ Accepts the connections and routes them to the worker processes. """
+
+    def __init__(self, host=HOST, port=PORT, n_workers=None, log_dir=EVENT_LOG_DIR, recordings_dir=RECORDINGS_DIR,
+                 log_level=LOG_LEVEL, drain_timeout=DRAIN_TIMEOUT, bot_delay=BOT_FILL_DELAY, bot_budget=BOT_TIME_BUDGET):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.worker_args = (log_dir, recordings_dir, log_level, bot_delay, bot_budget)
+        self.drain_timeout = drain_timeout
+
+        self.listener = socket.create_server((host, port), backlog=128)
+        self.listener.setblocking(False)
+        self.PORT = self.listener.getsockname()[1]
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+
+        self.lock = Lock()                  # The routing state is also read by the stats thread
+        self.workers = {}                   # KEY: index   VALUE: Worker
+        self.routes = {}                    # KEY: room name   VALUE: Worker, for the rooms named by the players
+        self.filling = None                 # Worker getting the players that do not name a room
+        self.filling_left = 0
+
+        self.handshakes = {}                # KEY: socket   VALUE: (time accepted, client address)
+        self.waiting = []                   # Sockets with a partial handshake, not selected until the next loop
+        self.shutting_down = False
+
+        for index in range(self.n_workers):
+            self.start_worker(index)
+
+    # Workers:
+
+    def start_worker(self, index):
+        conn, worker_conn = CONTEXT.Pipe()
+        process = CONTEXT.Process(target=run_worker, args=(index, worker_conn, *self.worker_args),
+                                          name=f'hanabi-worker-{index}', daemon=True)
+        process.start()
+        worker_conn.close()
+
+        worker = Worker(index, process, conn)
+        with self.lock:
+            self.workers[index] = worker
+        self.selector.register(conn, selectors.EVENT_READ, functools.partial(self.read_worker, worker))
+        logger.info('Started worker %d, pid %d.', index, process.pid)
+
+    def read_worker(self, worker, conn):
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            logger.error('Worker %d is gone.', worker.index)
+            self.stop_worker(worker, replace=not self.shutting_down)
+            return
+
+        if message[0] == 'stats':
+            _, exported, rooms = message
+            now = time.monotonic()
+            with self.lock:
+                worker.exported = exported
+
+                # A routed room the worker has not opened yet keeps its route for a while:
+                worker.routed_at = {name: routed for name, routed in worker.routed_at.items()
+                                    if name not in rooms and now - routed < ROUTE_GRACE}
+                for name in worker.rooms - set(rooms) - set(worker.routed_at):
+                    if self.routes.get(name) is worker:
+                        del self.routes[name]
+                worker.rooms = set(rooms) | set(worker.routed_at)
+
+                # The rooms the worker recovered from its event logs, their players come back by name:
+                for name in rooms:
+                    if name not in self.routes and AUTO_ROOM_NAME.match(name) is None:
+                        self.routes[name] = worker
+
+    def drain(self, index):
+
+        """ Stops new rooms on a worker. Returns False if there is no such worker. """
+
+        with self.lock:
+            worker = self.workers.get(index)
+            if worker is None or worker.draining:
+                return False
+            worker.draining_since = time.monotonic()
+            if self.filling is worker:
+                self.filling = None
+
+        logger.info('Draining worker %d with %d rooms.', index, len(worker.rooms))
+        try:
+            worker.send(('drain', ))
+        except OSError as ex:
+            # The worker is gone, read_worker() will notice it:
+            logger.warning('Could not drain worker %d: %s', index, ex)
+        return True
+
+    def check_drained(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if not worker.draining:
+                continue
+            if not worker.rooms:
+                logger.info('Worker %d is drained.', worker.index)
+            elif now - worker.draining_since > self.drain_timeout:
+                logger.warning('Worker %d did not finish its %d rooms in time.', worker.index, len(worker.rooms))
+            else:
+                continue
+            self.stop_worker(worker, replace=not self.shutting_down)
+
+    def stop_worker(self, worker, replace=False):
+        with self.lock:
+            if self.workers.get(worker.index) is not worker:
+                return
+            del self.workers[worker.index]
+            for name in worker.rooms:
+                if self.routes.get(name) is worker:
+                    del self.routes[name]
+            if self.filling is worker:
+                self.filling = None
+
+        self.selector.unregister(worker.conn)
+        worker.conn.close()
+        worker.process.join(timeout=5)
+        if worker.process.is_alive():
+            # Workers ignore SIGTERM:
+            worker.process.kill()
+
+        if replace:
+            self.start_worker(worker.index)
+
+    # Routing:
+
+    def least_loaded(self):
+        workers = [worker for worker in self.workers.values() if not worker.draining]
+        return min(workers, key=lambda worker: len(worker.rooms), default=None)
+
+    def route(self, attempt):
+
+        """ The worker for a ConnectionAttempt, or None if no worker takes new players. """
+
+        name = getattr(attempt, 'room', '')
+
+        with self.lock:
+            if not name:
+                if self.filling is None or self.filling_left <= 0:
+                    self.filling = self.least_loaded()
+                    self.filling_left = MAX_PLAYERS
+                self.filling_left -= 1
+                return self.filling
+
+            # A room opened by a worker, unless the name only looks like one:
+            auto_name = AUTO_ROOM_NAME.match(name)
+            if auto_name is not None and int(auto_name.group(1)) in self.workers:
+                return self.workers[int(auto_name.group(1))]
+
+            worker = self.routes.get(name)
+            if worker is None:
+                worker = self.least_loaded()
+                if worker is not None:
+                    self.routes[name] = worker
+                    worker.rooms.add(name)
+                    worker.routed_at[name] = time.monotonic()
+            return worker
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            self.handshakes[sock] = (time.monotonic(), address)
+            self.selector.register(sock, selectors.EVENT_READ, self.read_handshake)
+
+    def read_handshake(self, sock):
+
+        """ Peeks at the first packet of a new connection. The data stays in the socket for the worker. """
+
+        try:
+            data = sock.recv(HANDSHAKE_MAX_SIZE + packets.HEADER.size, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if len(data) >= packets.HEADER.size:
+            (size, ) = packets.HEADER.unpack_from(data)
+            if size > HANDSHAKE_MAX_SIZE:
+                data = b''
+
+            # Not all there yet. The unread data keeps the socket readable, so it is not selected for a moment:
+            elif len(data) < packets.HEADER.size + size:
+                self.selector.unregister(sock)
+                self.waiting.append(sock)
+                return
+
+        elif data:
+            self.selector.unregister(sock)
+            self.waiting.append(sock)
+            return
+
+        self.selector.unregister(sock)
+        _, address = self.handshakes.pop(sock)
+
+        attempt = None
+        if data:
+            try:
+                attempt = packets.load(data[packets.HEADER.size:packets.HEADER.size + size])
+            except Exception as ex:
+                logger.warning('Unreadable handshake from %s: %s', address, ex)
+
+        if type(attempt) is not packets.ConnectionAttempt:
+            sock.close()
+            return
+
+        worker = self.route(attempt)
+        if worker is None:
+            logger.warning('No worker takes new players, denying %s.', attempt.user_name)
+            response = packets.ConnectionConfirmed(False, attempt.user_name, 999, room=getattr(attempt, 'room', ''))
+            sock.setblocking(True)
+            try:
+                sock.sendall(response.to_bytes())
+            except OSError:
+                pass
+            sock.close()
+            return
+
+        sock.setblocking(True)
+        try:
+            worker.send(('connection', sock, address))
+            metrics.count('connections_routed')
+        except OSError as ex:
+            logger.error('Could not hand %s over to worker %d: %s', address, worker.index, ex)
+        sock.close()
+
+    def expire_handshakes(self):
+        now = time.monotonic()
+        for sock, (accepted, address) in list(self.handshakes.items()):
+            if now - accepted > HANDSHAKE_TIMEOUT:
+                logger.info('No handshake from %s, closing.', address)
+                del self.handshakes[sock]
+                if sock in self.waiting:
+                    self.waiting.remove(sock)
+                else:
+                    self.selector.unregister(sock)
+                sock.close()
+
+    # Main loop:
+
+    def serve_forever(self):
+        last_check = 0.0
+
+        while self.workers or not self.shutting_down:
+            # Partial handshakes are selected again once per loop:
+            for sock in self.waiting:
+                self.selector.register(sock, selectors.EVENT_READ, self.read_handshake)
+            timeout = 0.01 if self.waiting else 0.5
+            self.waiting = []
+
+            for key, _ in self.selector.select(timeout):
+                key.data(key.fileobj)
+
+            if time.monotonic() - last_check >= 0.5:
+                last_check = time.monotonic()
+                self.expire_handshakes()
+                self.check_drained()
+
+        logger.info('All workers are done.')
+
+    def shutdown(self, *args):
+
+        """ Stops accepting connections and drains all the workers. Called a second time, it stops them right
+        away. """
+
+        if self.shutting_down:
+            logger.warning('Stopping the workers without waiting for their games.')
+            self.drain_timeout = 0
+            return
+
+        logger.info('Shutting down, draining all workers. Again to stop right away.')
+        self.shutting_down = True
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        for index in list(self.workers):
+            self.drain(index)
+
+    # Stats:
+
+    def snapshot(self):
+
+        """ The metrics of all the workers together, the front and every worker on its own. """
+
+        total = Metrics()
+        total.merge(metrics.export())
+        workers = []
+
+        with self.lock:
+            for worker in self.workers.values():
+                if worker.exported is not None:
+                    total.merge(worker.exported)
+                workers.append({'index': worker.index,
+                                'pid': worker.process.pid,
+                                'draining': worker.draining,
+                                'rooms': len(worker.rooms),
+                                'process': worker.exported['process'] if worker.exported is not None else None})
+
+        snapshot = total.snapshot()
+        snapshot['process'] = process_stats()
+        snapshot['workers'] = workers
+
+        # The whole server, to compare with a single process server:
+        processes = [snapshot['process']] + [worker['process'] for worker in workers if worker['process']]
+        snapshot['total_process'] = {'cpu_s': sum(process['cpu_s'] for process in processes),
+                                     'rss_kb': sum(process.get('rss_kb', 0) for process in processes) or None,
+                                     'threads': sum(process['threads'] for process in processes)}
+        return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PyHanabi game server with one worker process per core')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, by default one per core')
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--log-dir', default=EVENT_LOG_DIR,
+                        help='keep the games in event logs in this directory and continue them after a restart')
+    parser.add_argument('--record', default=RECORDINGS_DIR, help='record the games into this directory for replays')
+    parser.add_argument('--log-level', default=LOG_LEVEL, help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='log the stats of all the workers every this many seconds, 0 to not log them')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='serve the stats as JSON on this local HTTP port, POST /drain/<worker> drains a worker')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help='seconds a draining worker has to finish its games')
+    parser.add_argument('--bots-after', type=float, default=BOT_FILL_DELAY, metavar='SECONDS',
+                        help='fill the free seats of a room with bots after it waited this long for players')
+    parser.add_argument('--bot-budget', type=float, default=BOT_TIME_BUDGET, metavar='SECONDS',
+                        help='time a bot may search for each move')
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+
+    server = ShardedServer(args.host, args.port, args.workers, args.log_dir, args.record, args.log_level,
+                           args.drain_timeout, args.bots_after, args.bot_budget)
+
+    if args.stats_interval:
+        dump_periodically(args.stats_interval, source=server)
+    if args.stats_port is not None:
+        serve_stats(args.stats_port, source=server, handler_class=StatsHandler)
+
+    signal.signal(signal.SIGINT, server.shutdown)
+    signal.signal(signal.SIGTERM, server.shutdown)
+
+    logger.info('Waiting for connections on port %d with %d workers...', server.PORT, server.n_workers)
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
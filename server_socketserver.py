@@ -1,9 +1,18 @@
 import socketserver
+import socket
+import logging
 import packets
-import pprint
-import time
+import argparse
+from functools import partial
+from threading import Lock, Timer
 from settings import *
-from game_logic import GameState
+from rooms import RoomRegistry
+from event_log import EventLogStore
+from bots import BotPlayer, BOT_PREFIX
+from metrics import metrics, serve_stats, dump_periodically
+from log import setup_logging
+
+logger = logging.getLogger(__name__)
 
 
 class RequestHandler(socketserver.StreamRequestHandler):
@@ -14,121 +23,222 @@ class RequestHandler(socketserver.StreamRequestHandler):
         super().__init__(request, client_address, server)
 
     def setup(self):
-        print(f'Connecting client with address: {self.client_address}.')
+        logger.info('Connecting client with address: %s.', self.client_address)
+        self.send_lock = Lock()         # Broadcasts come from other clients' threads, keep the frames whole.
+        self.codec = 'json'             # Codec negotiated in the connection handshake
+        self.room = None                # Game room, set by the connection handshake
+
+        # Send the broadcasts right away. With Nagle's algorithm a broadcast waits for the delayed ACK of the
+        # previous one from a client that has nothing to send back, e.g. while it is not their turn:
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.server.add_client(self)
 
     def send_game_state(self, data):
-        self.request.send(data)
+        try:
+            with self.send_lock:
+                self.request.sendall(data)
+        except OSError as ex:
+            # The reading thread of this client will notice the broken connection and clean up:
+            logger.warning('Sending to %s failed: %s', self.client_address, ex)
 
     def handle(self):
 
-        """ Continuosly wait for a data packet and handle two scenarios:
-        1) connection attempts until max players is reached
-        2) player events -> which will update the server game state. """
+        """ Continuosly wait for data and cut it into packets. A single recv() can hold several packets or
+        only a part of one, the decoder keeps the rest until the next recv(). """
+
+        decoder = packets.PacketDecoder()
 
         while True:
-            # Receive a data packet:
+            # Receive data from the stream:
             try:
                 data = self.request.recv(self.server.BUFFERSIZE)
             except ConnectionResetError as ex:
-                print('Client disconnected.', ex)
+                logger.info('Client disconnected: %s', ex)
                 return
+
+            # An empty read means the client closed the connection:
             if not data:
-                continue
+                logger.info('Client closed the connection.')
+                return
 
-            # Decode the data packet and convert it back to a DataPacket object
-            data = packets.load(data)
+            # Decode the complete data packets and convert them back to DataPacket objects
+            decoder.feed(data)
+            if not self.server.handle_packets(self, decoder):
+                return
 
-            # If the client is trying to establish connection handshake:
-            if type(data) is packets.ConnectionAttempt:
+    def handle_packet(self, data):
+        return self.server.handle_packet(self, data)
 
-                # Accept players until we reach MAX count:
-                if self.server.player_count < MAX_PLAYERS:
+    def finish(self):
+        logger.info('Disconnecting client with address: %s!', self.client_address)
+        # setup() does not make the rfile/wfile of the StreamRequestHandler, the socket is used directly, so
+        # there is nothing for super().finish() to flush and close:
+        self.server.remove_client(self)
 
-                    # Store player data in server's dictionary:
-                    player_id = self.server.player_count
-                    self.server.players[player_id] = data.user_name
 
-                    # Confirm connection handshake and player id sync:
-                    response = packets.ConnectionConfirmed(True, data.user_name, player_id)
-                    self.request.send(response.to_bytes())
+class GameServer:
 
-                    # Increase player count, if we reached max_player: start the game:
-                    self.server.player_count += 1
-                    if self.server.player_count == MAX_PLAYERS:
-                        self.server.start_game()
+    """ The game side of the server: places the connecting players into rooms and passes their packets on to
+    the room. It does not depend on the transport, clients only need a send_game_state(data) method, a codec
+    and a room attribute. """
 
-                    # Wait a bit for the client to start its threads and send the initial game state update:
-                    time.sleep(0.2)
-                    self.server.broadcast_game_state_update()
+    def __init__(self, log_dir=EVENT_LOG_DIR, recordings_dir=RECORDINGS_DIR, bot_delay=BOT_FILL_DELAY,
+                 bot_budget=BOT_TIME_BUDGET):
+        self.PORT = PORT
+        self.BUFFERSIZE = 4096
+        self.clients = set()
 
-                    continue
+        # Seconds a room waits for players before bots fill its free seats (None for no bots), and the
+        # seconds a bot may search for each move:
+        self.bot_delay = bot_delay
+        self.bot_budget = bot_budget
 
-                else:
+        # Game rooms, each with its own Game State, written to the event logs in log_dir if given
+        # and recorded for replays in recordings_dir if given:
+        event_logs = EventLogStore(log_dir) if log_dir else None
+        self.rooms = RoomRegistry(event_logs, recordings_dir)
 
-                    # Deny connection when above MAX player count is reached and disconnect the client:
-                    response = packets.ConnectionConfirmed(False, data.user_name, 999)
-                    self.request.send(response.to_bytes())
+    def handle_packets(self, client, decoder):
 
-                    return
+        """ Decodes and handles the complete packets in the decoder.
 
-            elif type(data) in packets.get_events():
-                self.server.update_game_state(event=data)
-                self.server.broadcast_game_state_update()
+        Returns False when the client has to be disconnected. """
 
-    def finish(self):
-        print(f'Disconnecting client with address: {self.client_address}!')
-        self.server.remove_client(self)
-        try:
-            super().finish()
-        except AttributeError as ex:
-            print('RequestHandler finish() dropped exception:', ex)
+        while True:
+            payload = decoder.next_payload()
+            if payload is None:
+                return True
 
+            with metrics.timer('decode'):
+                packet = packets.load(payload)
+            metrics.count('packets_received')
 
-class Server(socketserver.ThreadingTCPServer):
+            if not self.handle_packet(client, packet):
+                return False
 
-    """ Handle TCP connections and all Player Events to update and broadcast the Game state """
+    def handle_packet(self, client, data):
 
-    def __init__(self, request_handler_class):
-        self.PORT = 10000
-        self.BUFFERSIZE = 4096
-        self.clients = set()
-        super().__init__(('localhost', self.PORT), request_handler_class)
+        """ Handle two scenarios:
+        1) connection attempts, which place the client in a room
+        2) player events -> which will update the game state of the client's room.
 
-        # Player connections:
-        self.player_count = 0
-        self.players = {}
+        Returns False when the client has to be disconnected. """
 
-        # Game State:
-        self.GS = GameState(MAX_PLAYERS)
+        # If the client is trying to establish connection handshake:
+        if type(data) is packets.ConnectionAttempt:
+            if client.room is not None:
+                logger.warning('Client is already in a room.')
+                return True
 
-    def add_client(self, client):
-        self.clients.add(client)
+            client.room = self.rooms.join(client, data)
+            if client.room is not None and self.bot_delay is not None:
+                self.call_later(self.bot_delay, partial(self.fill_seats, client.room))
+            return client.room is not None
+
+        # Everything else needs a finished handshake:
+        if client.room is None:
+            logger.warning('Dropped %s from a client without a room.', type(data).__name__)
+
+        elif type(data) in packets.get_events():
+            client.room.handle_event(event=data, client=client)
+
+        # The client missed a delta, send it the full game state:
+        elif type(data) is packets.ResyncRequest:
+            metrics.count('resync_requests')
+            client.room.send_game_state_snapshot(client)
+
+        return True
+
+    def fill_seats(self, room):
+
+        """ Seats bots on the free seats of a room that waited bot_delay seconds for its players. In a game
+        recovered from the event log, the seats of the bots are given to new bots. """
+
+        with self.rooms.lock:
+            # The room may be gone or full by now:
+            if self.rooms.rooms.get(room.name) is not room or not room.has_humans():
+                return
 
-    def broadcast_game_state_update(self):
+            with room.lock:
+                if room.is_open():
+                    names = [f'{BOT_PREFIX}{i}' for i in range(room.player_count + 1, room.n_players + 1)]
+                else:
+                    names = [name for player_id, name in room.players.items()
+                             if name.startswith(BOT_PREFIX) and player_id not in room.seats]
+
+                for name in names:
+                    room.add_bot(BotPlayer(self, name, self.bot_budget))
+
+    def call_soon(self, function):
 
-        """ Send the GS game state to all the connected clients."""
+        """ Runs a function for a thread that is not one of the server's, e.g. the Turn of a bot. """
 
-        pprint.pprint(self.GS.__dict__)
+        function()
 
-        for client in tuple(self.clients):
-            client.send_game_state(self.GS.to_bytes(self.players))
+    def call_later(self, delay, function):
+        timer = Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+
+    def add_client(self, client):
+        self.clients.add(client)
+        metrics.count('connections')
 
     def remove_client(self, client):
-        self.clients.remove(client)
+        self.clients.discard(client)
+        metrics.count('disconnections')
+        if client.room is not None:
+            self.rooms.leave(client, client.room)
+
+
+class Server(GameServer, socketserver.ThreadingTCPServer):
+
+    """ Handle TCP connections with one thread per client and all Player Events to update and broadcast
+    the Game state """
 
-    def start_game(self):
-        print('Starting game...')
-        self.GS.started = True
-        self.broadcast_game_state_update()
+    request_queue_size = 128            # Backlog of the listening socket, many clients may connect at once
 
-    def update_game_state(self, event):
-        self.GS.update(event=event)
+    def __init__(self, request_handler_class, host=HOST, port=PORT, log_dir=EVENT_LOG_DIR,
+                 recordings_dir=RECORDINGS_DIR, bot_delay=BOT_FILL_DELAY, bot_budget=BOT_TIME_BUDGET):
+        GameServer.__init__(self, log_dir, recordings_dir, bot_delay, bot_budget)
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), request_handler_class)
+        self.PORT = self.server_address[1]      # The bound port, when port 0 asked for any free one
 
 
 def main():
-    server = Server(RequestHandler)
-    print('Waiting for connections...')
+    parser = argparse.ArgumentParser(description='PyHanabi game server')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve all connections from one asyncio event loop instead of one thread per client')
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--log-dir', default=EVENT_LOG_DIR,
+                        help='keep the games in event logs in this directory and continue them after a restart')
+    parser.add_argument('--record', default=RECORDINGS_DIR, help='record the games into this directory for replays')
+    parser.add_argument('--log-level', default=LOG_LEVEL, help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='log the server stats every this many seconds, 0 to not log them')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='serve the server stats as JSON on this local HTTP port')
+    parser.add_argument('--bots-after', type=float, default=BOT_FILL_DELAY, metavar='SECONDS',
+                        help='fill the free seats of a room with bots after it waited this long for players')
+    parser.add_argument('--bot-budget', type=float, default=BOT_TIME_BUDGET, metavar='SECONDS',
+                        help='time a bot may search for each move')
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    if args.stats_interval:
+        dump_periodically(args.stats_interval)
+    if args.stats_port is not None:
+        serve_stats(args.stats_port)
+
+    if args.asyncio:
+        import server_asyncio
+        return server_asyncio.main(args.host, args.port, args.log_dir, args.record, args.bots_after,
+                                   args.bot_budget)
+
+    server = Server(RequestHandler, args.host, args.port, args.log_dir, args.record, args.bots_after,
+                    args.bot_budget)
+    logger.info('Waiting for connections...')
     server.serve_forever()
     return 0
 
@@ -3,6 +3,20 @@
 
 MAX_PLAYERS = 2
 
+# Server Settings:
+HOST = 'localhost'
+PORT = 10000
+DEBUG_STATE_DUMP = False    # Print the whole game state after every broadcast
+EVENT_LOG_DIR = None        # Directory of the event logs for crash recovery, None keeps the games in memory only
+RECORDINGS_DIR = None       # Directory for the recordings of the games for replay.py, None to not record
+LOG_LEVEL = 'INFO'          # DEBUG shows every game state update
+STATS_INTERVAL = 0          # Seconds between the stats dumps to the log, 0 to not dump them
+STATS_PORT = None           # Local HTTP port serving the stats as JSON, None to not serve them
+FINISHED_ROOM_GRACE = 60    # Seconds a finished game stays open for its players before the room is closed
+RECOVERED_ROOM_TIMEOUT = 600 # Seconds a recovered game waits for its players before it is given up
+BOT_FILL_DELAY = None       # Seconds a room waits for players before bots take the free seats, None for no bots
+BOT_TIME_BUDGET = 0.1       # Seconds a bot searches for its move
+
 
 # Game Window Settings:
 SCREEN_WIDTH = 800
@@ -29,6 +43,10 @@ SPACING_TOP = SPACING_BOT
 SPACING_LEFT = [30, 105, 180, 255]
 SPACING_RIGHT = [SCREEN_WIDTH - SPACING_LEFT[i] for i in range(-1, -5, -1)]
 
+TABLE_ROW = int(SCREEN_HEIGHT/2) - 70
+SPACING_TABLE = [SCREEN_WIDTH/2+int(i*1.25*X_SPACING) for i in range(-2, 3)]    # One column per color
+DISCARD_X = SPACING_LEFT[0] + 40
+
 CARD_LOCATIONS = {'bot': [(SPACING_BOT[0], BOT_ROW),
                           (SPACING_BOT[1], BOT_ROW),
                           (SPACING_BOT[2], BOT_ROW),
@@ -44,4 +62,6 @@ CARD_LOCATIONS = {'bot': [(SPACING_BOT[0], BOT_ROW),
                   'right': [(SPACING_RIGHT[0], MID_ROW),
                             (SPACING_RIGHT[1], MID_ROW),
                             (SPACING_RIGHT[2], MID_ROW),
-                            (SPACING_RIGHT[3], MID_ROW)]}
+                            (SPACING_RIGHT[3], MID_ROW)],
+                  'table': [(x, TABLE_ROW) for x in SPACING_TABLE],
+                  'discard': [(DISCARD_X, TABLE_ROW)]}
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+import urllib.request
+import packets
+from packets import ConnectionAttempt, ConnectionConfirmed, GameStateUpdate, InfoUsed, NextTurn, Turn
+from server_socketserver import GameServer
+
+''' Crash recovery of the games: the server is stopped without any cleanup, a new one is started on the same
+event log directory, and the players get their seats back in the game by joining its room with their name.'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClient:
+
+    """ A room client that keeps the packets the server sends it. """
+
+    def __init__(self):
+        self.codec = 'json'
+        self.room = None
+        self.received = []
+
+    def send_game_state(self, data):
+        self.received.append(packets.load(data[packets.HEADER.size:]))
+
+
+def test_threaded_server_recovers_a_game(tmp_path):
+    server = GameServer(str(tmp_path))
+    clients = {}
+    for name in ('ann', 'bob'):
+        client = FakeClient()
+        server.add_client(client)
+        assert server.handle_packet(client, ConnectionAttempt(name, ('binary', ), 'foo'))
+        clients[client.received[0].player_id] = client
+
+    game_state = server.rooms.rooms['foo'].GS
+    for _ in range(3):
+        player = game_state.current_player
+        server.handle_packet(clients[player], Turn(player, [InfoUsed(player), NextTurn(player)]))
+    time.sleep(0.5)     # The snapshot and the fsync are done by the sync thread
+
+    # The first server is left as it is, like after a crash:
+    restarted = GameServer(str(tmp_path))
+    recovered = restarted.rooms.rooms['foo'].GS
+    assert recovered.version == game_state.version == 3
+    assert recovered.player_hands == game_state.player_hands
+
+    client = FakeClient()
+    restarted.add_client(client)
+    assert restarted.handle_packet(client, ConnectionAttempt('bob', ('json', ), 'foo'))
+    confirmed, update = client.received[:2]
+    assert confirmed.confirmed and confirmed.player_id == 1
+    assert type(update) is GameStateUpdate and update.started and update.version == 3
+
+
+# --- Sharded server --- #
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class SocketClient:
+
+    """ A player connected over TCP, reading the packets of the server one by one. """
+
+    def __init__(self, port, name, room):
+        self.sock = socket.create_connection(('localhost', port))
+        self.sock.settimeout(10)
+        self.decoder = packets.PacketDecoder()
+        self.state = None
+        self.sock.sendall(ConnectionAttempt(name, ('binary', ), room).to_bytes())
+
+    def next_packet(self):
+        while True:
+            packet = self.decoder.next_packet()
+            if packet is not None:
+                if type(packet) is GameStateUpdate:
+                    self.state = packet
+                elif type(packet) is packets.GameStateDelta:
+                    self.state = self.state.apply_delta(packet)
+                return packet
+            self.decoder.feed(self.sock.recv(65536))
+
+    def wait_for(self, condition):
+        while True:
+            packet = self.next_packet()
+            if condition(packet):
+                return packet
+
+    def close(self):
+        self.sock.close()
+
+
+def start_sharded_server(port, stats_port, log_dir):
+    process = subprocess.Popen([sys.executable, 'server_sharded.py', '--workers', '2', '--port', str(port),
+                                '--stats-port', str(stats_port), '--log-dir', log_dir, '--log-level', 'WARNING'],
+                               cwd=ROOT, start_new_session=True)
+
+    # Up once every worker has reported its rooms:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            stats = json.load(urllib.request.urlopen(f'http://localhost:{stats_port}/'))
+            if len(stats['workers']) == 2 and all(worker['process'] for worker in stats['workers']):
+                return process, stats
+        except (OSError, ValueError, KeyError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('The sharded server did not start.')
+
+
+def test_sharded_server_recovers_a_named_room(tmp_path):
+    port, stats_port = free_port(), free_port()
+    log_dir = str(tmp_path)
+
+    process, _ = start_sharded_server(port, stats_port, log_dir)
+    clients = {}
+    try:
+        for name in ('ann', 'bob'):
+            client = SocketClient(port, name, 'foo')
+            confirmed = client.wait_for(lambda packet: type(packet) is ConnectionConfirmed)
+            assert confirmed.confirmed
+            clients[confirmed.player_id] = client
+
+        for client in clients.values():
+            client.wait_for(lambda packet: type(packet) is GameStateUpdate and packet.started)
+
+        for version in range(1, 4):
+            player = clients[0].state.current_player
+            clients[player].sock.sendall(Turn(player, [InfoUsed(player), NextTurn(player)]).to_bytes('binary'))
+            for client in clients.values():
+                client.wait_for(lambda packet: client.state.version >= version)
+        time.sleep(0.5)
+    finally:
+        # A crash of the whole server, nothing is drained or cleaned up:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        for client in clients.values():
+            client.close()
+
+    process, stats = start_sharded_server(port, stats_port, log_dir)
+    try:
+        assert sum(worker['rooms'] for worker in stats['workers']) == 1
+
+        client = SocketClient(port, 'bob', 'foo')
+        confirmed = client.wait_for(lambda packet: type(packet) is ConnectionConfirmed)
+        assert confirmed.confirmed and confirmed.player_id == 1
+
+        update = client.wait_for(lambda packet: type(packet) is GameStateUpdate)
+        assert update.started and update.version == 3
+        client.close()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)